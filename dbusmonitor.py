@@ -20,12 +20,22 @@ from gi.repository import GLib
 import dbus
 import dbus.service
 import logging
+import math
 import os
-from collections import defaultdict
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import Future
 from functools import partial
+from queue import Queue, Empty
+from types import MappingProxyType
 
 # our own packages
-from ve_utils import exit_on_error, wrap_dbus_value, unwrap_dbus_value, add_name_owner_changed_receiver
+from ve_utils import exit_on_error, wrap_dbus_value, unwrap_dbus_value, add_name_owner_changed_receiver, \
+	ValueChanges
 
 # dbus interface
 VE_INTERFACE = "com.victronenergy.BusItem"
@@ -33,8 +43,84 @@ VE_INTERFACE = "com.victronenergy.BusItem"
 # For lookups where None is a valid result
 notfound = object()
 
+# Options in the dbusTree that limit how often valueChangedCallback is called
+# for a path. minInterval and debounce are in milliseconds.
+#  minInterval: at most one callback per interval, with the latest value.
+#  debounce: only call back once the value has not changed for this long.
+#  deadband: skip changes smaller than this from the last value passed on.
+rate_limit_options = frozenset(('minInterval', 'debounce', 'deadband'))
+
+# The 'priority' option in the dbusTree orders the changes waiting for
+# valueChangedCallback: higher priorities are passed on first. The default is
+# 0, these are some suggested levels.
+PRIORITY_LOW = -10
+PRIORITY_DEFAULT = 0
+PRIORITY_HIGH = 10
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+
+def is_path_pattern(path):
+	""" Returns True if a key in the dbusTree is a pattern rather than a
+	    literal path. A pattern is either a compiled regular expression, which
+	    has to match the whole path, or a string containing glob characters: '*' matches any number of
+	    characters within one path element, '?' matches a single character
+	    and '[...]' matches a set of characters, eg '/Pv/*/V' or
+	    '/Ac/L[123]/P'. """
+	return not isinstance(path, str) or any(c in path for c in '*?[')
+
+def compile_path_pattern(pattern):
+	""" Compiles a glob-style path into a regular expression. Compiled
+	    regular expressions are returned as is. """
+	if not isinstance(pattern, str):
+		return pattern
+
+	r = []
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		i += 1
+		if c == '*':
+			r.append('[^/]*')
+		elif c == '?':
+			r.append('[^/]')
+		elif c == '[':
+			j = pattern.find(']', i + 1)
+			if j < 0:
+				r.append(re.escape(c))
+				continue
+			chars = pattern[i:j]
+			if chars.startswith('!'):
+				chars = '^' + chars[1:]
+			r.append('[' + chars.replace('\\', '\\\\') + ']')
+			i = j + 1
+		else:
+			r.append(re.escape(c))
+	return re.compile(''.join(r) + r'\Z')
+
+class GLibScheduler(object):
+	""" Defers work to the GLib mainloop. DbusMonitor uses this unless it is
+	    given another scheduler, see ve_asyncio.AsyncioScheduler for one that
+	    uses an asyncio event loop. Callbacks run once, and exceptions in them
+	    terminate the process, as with exit_on_error. """
+	def call_soon(self, callback, *args):
+		return GLib.idle_add(_call_once, callback, *args)
+
+	def call_later(self, delay, callback, *args):
+		""" Calls callback after delay milliseconds. """
+		return GLib.timeout_add(delay, _call_once, callback, *args)
+
+	def call_soon_threadsafe(self, callback, *args):
+		""" Like call_soon, but may be called from any thread. """
+		GLib.idle_add(_call_once, callback, *args)
+
+	def cancel(self, handle):
+		GLib.source_remove(handle)
+
+def _call_once(callback, *args):
+	exit_on_error(callback, *args)
+	return False
+
 class SystemBus(dbus.bus.BusConnection):
 	def __new__(cls):
 		return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SYSTEM)
@@ -43,13 +129,84 @@ class SessionBus(dbus.bus.BusConnection):
 	def __new__(cls):
 		return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
 
+class History(object):
+	""" Ring buffer of the last size (timestamp, value) samples of a path,
+	    kept in two preallocated arrays of doubles. Timestamps are
+	    time.monotonic() seconds, invalid values are stored as NaN and
+	    values that are not numbers are left out. """
+	def __init__(self, size):
+		super(History, self).__init__()
+		self.timestamps = array('d', bytes(8 * size))
+		self.values = array('d', bytes(8 * size))
+		self.next = 0
+		self.count = 0
+
+	def append(self, timestamp, value):
+		if value is None:
+			value = math.nan
+		elif not _is_number(value):
+			return
+		i = self.next
+		self.timestamps[i] = timestamp
+		self.values[i] = value
+		self.next = (i + 1) % len(self.values)
+		if self.count < len(self.values):
+			self.count += 1
+
+	def get(self, start=None, end=None):
+		""" Returns arrays of the timestamps and values of the samples from
+		    start up to and including end, oldest first. """
+		size = len(self.values)
+		first = (self.next - self.count) % size
+		if first + self.count <= size:
+			segments = ((first, first + self.count),)
+		else:
+			segments = ((first, size), (0, self.next))
+
+		timestamps = array('d')
+		values = array('d')
+		for lo, hi in segments:
+			if start is not None:
+				lo = bisect_left(self.timestamps, start, lo, hi)
+			if end is not None:
+				hi = bisect_right(self.timestamps, end, lo, hi)
+			timestamps.extend(self.timestamps[lo:hi])
+			values.extend(self.values[lo:hi])
+		return timestamps, values
+
 class MonitoredValue(object):
+	# Stale watches on this value, see DbusMonitor.add_stale_watch
+	staleWatches = None
+
+	# Past values, for paths with the history option
+	history = None
+
+	# Statistics over the current interval, see DbusMonitor.add_interval_stats
+	intervalStats = None
+
+	# DbusMonitor.version at which the value last changed
+	version = 0
+
 	def __init__(self, value, text, options):
 		super(MonitoredValue, self).__init__()
 		self.value = value
 		self.text = text
 		self.options = options
 
+		# time.monotonic() of the last scan or signal for this path
+		self.timestamp = time.monotonic()
+
+	# Text is only stored when it was received, otherwise it is made from the
+	# value when asked for.
+	@property
+	def text(self):
+		text = self._text
+		return str(self.value) if text is notfound else text
+
+	@text.setter
+	def text(self, text):
+		self._text = text
+
 	# For legacy code, allow treating this as a tuple/list
 	def __iter__(self):
 		return iter((self.value, self.text, self.options))
@@ -76,10 +233,602 @@ class Service(object):
 	def seen(self, path):
 		return path in self._seen
 
+	def remove_path(self, path):
+		self.paths.pop(path, None)
+		self._seen.discard(path)
+
 	@property
 	def service_class(self):
 		return '.'.join(self.name.split('.')[:3])
 
+class Aggregate(object):
+	""" Keeps the sum, min, max, count or mean of one path over all services
+	    of a class. Only numeric values take part, invalid values are left
+	    out. Create these using DbusMonitor.add_aggregate. """
+	kinds = ('sum', 'min', 'max', 'count', 'mean')
+
+	# Re-add the total from scratch every so many updates, so that rounding
+	# errors from adding and subtracting floats do not accumulate.
+	resum_interval = 1000
+
+	def __init__(self, serviceClass, path, kind):
+		super(Aggregate, self).__init__()
+		if kind not in self.kinds:
+			raise ValueError("Unknown aggregate %s, use one of %s" % (kind, ', '.join(self.kinds)))
+		self.serviceClass = serviceClass
+		self.path = path
+		self.kind = kind
+		self.callbacks = []
+		self.notified = None
+		self.pending = False
+		self._values = {}
+		self._total = 0
+		self._extreme = None
+		self._updates = 0
+
+	def reset(self, values):
+		""" Recalculates from scratch, values is a sequence of
+		    (serviceName, value) tuples. """
+		self._values = { name: v for name, v in values if _is_number(v) }
+		self._total = math.fsum(self._values.values())
+		self._extreme = self._find_extreme()
+		self._updates = 0
+
+	def _find_extreme(self):
+		if not self._values or self.kind not in ('min', 'max'):
+			return None
+		return (min if self.kind == 'min' else max)(self._values.values())
+
+	def update(self, serviceName, value):
+		old = self._values.pop(serviceName, None)
+		if old is not None:
+			self._total -= old
+		if _is_number(value):
+			self._values[serviceName] = value
+			self._total += value
+
+		self._updates += 1
+		if self._updates >= self.resum_interval or not self._values:
+			self._total = math.fsum(self._values.values())
+			self._updates = 0
+
+		if self.kind in ('min', 'max'):
+			if old is not None and old == self._extreme:
+				# The extreme was changed or withdrawn, only now do we
+				# have to look at all values again.
+				self._extreme = self._find_extreme()
+			elif _is_number(value) and (self._extreme is None or
+					(value < self._extreme if self.kind == 'min' else value > self._extreme)):
+				self._extreme = value
+
+	@property
+	def value(self):
+		if self.kind == 'count':
+			return len(self._values)
+		if not self._values:
+			return None
+		if self.kind == 'sum':
+			return self._total
+		if self.kind == 'mean':
+			return self._total / len(self._values)
+		return self._extreme
+
+def _is_number(v):
+	return isinstance(v, (int, float))
+
+class DerivedValue(object):
+	""" A value calculated from monitored paths and from other derived
+	    values. Create these using DbusMonitor.add_derived_value. """
+	def __init__(self, name, function):
+		super(DerivedValue, self).__init__()
+		self.name = name
+		self.function = function
+		self.inputs = set()
+		self.depends = []
+		self.dependents = []
+		self.callbacks = []
+		self.value = None
+		self.dirty = False
+
+IntervalSummary = namedtuple('IntervalSummary', 'min max mean last count')
+
+class IntervalStats(object):
+	""" Statistics of one path over the current interval of an
+	    IntervalGroup. The mean is weighted by how long each value was held.
+	    For values that are not numbers, min, max and mean are None. """
+	def __init__(self, group, key, value, now):
+		super(IntervalStats, self).__init__()
+		self.group = group
+		self.key = key
+		self.reset(value, now)
+
+	def reset(self, value, now):
+		self.last = value
+		self.since = now
+		self.count = 0
+		self.weighted = 0.0
+		self.duration = 0.0
+		self.min = self.max = value if _is_number(value) else None
+
+	def _hold(self, now):
+		if _is_number(self.last):
+			self.weighted += self.last * (now - self.since)
+			self.duration += now - self.since
+		self.since = now
+
+	def update(self, value, now):
+		self._hold(now)
+		self.last = value
+		self.count += 1
+		if _is_number(value):
+			if self.min is None or value < self.min:
+				self.min = value
+			if self.max is None or value > self.max:
+				self.max = value
+
+	def summary(self, now):
+		self._hold(now)
+		if self.duration:
+			mean = self.weighted / self.duration
+		else:
+			mean = self.last if _is_number(self.last) else None
+		return IntervalSummary(self.min, self.max, mean, self.last, self.count)
+
+class IntervalGroup(object):
+	""" The paths that are logged every interval seconds, see
+	    DbusMonitor.add_interval_stats. """
+	def __init__(self, interval, callback, select):
+		super(IntervalGroup, self).__init__()
+		self.interval = interval
+		self.callback = callback
+		self.select = select
+		self.stats = {}
+		self.timer = None
+
+Snapshot = namedtuple('Snapshot', 'version values')
+
+class SnapshotSet(object):
+	""" A set of (serviceName, path) pairs to take snapshots of, create
+	    these using DbusMonitor.snapshot_set. """
+	def __init__(self, monitor, items):
+		super(SnapshotSet, self).__init__()
+		self.monitor = monitor
+		self.items = tuple(items)
+		self.layoutVersion = None
+		self.resolved = None
+		self.resolvedVersion = None
+
+	def _resolve(self):
+		monitor = self.monitor
+		if self.layoutVersion != monitor._layoutVersion:
+			resolved = []
+			for serviceName, path in self.items:
+				service = monitor.servicesByName.get(serviceName)
+				resolved.append(None if service is None else service.paths.get(path))
+			self.resolved = resolved
+			self.layoutVersion = monitor._layoutVersion
+			self.resolvedVersion = monitor.version
+		return self.resolved
+
+	def read(self):
+		""" Returns a Snapshot of the values as they are now, with None for
+		    pairs that are not monitored. """
+		resolved = self._resolve()
+		return Snapshot(self.monitor.version, {item: None if a is None else a.value \
+			for item, a in zip(self.items, resolved)})
+
+	def changed_since(self, version):
+		""" Returns whether any of the values changed, or services of them
+		    came or went, after the snapshot with the given version. """
+		resolved = self._resolve()
+		if self.resolvedVersion > version:
+			return True
+		for a in resolved:
+			if a is not None and a.version > version:
+				return True
+		return False
+
+class MonitorState(object):
+	""" An immutable copy of all monitored values, see
+	    DbusMonitor.publish_state. Safe to read from any thread. """
+	def __init__(self, version, services, deviceInstances):
+		super(MonitorState, self).__init__()
+		self.version = version
+		self.services = services
+		self.deviceInstances = deviceInstances
+
+	def get_value(self, serviceName, objectPath, default_value=None):
+		value = self.services.get(serviceName, {}).get(objectPath, None)
+		return default_value if value is None else value
+
+	def get_service_list(self, classfilter=None):
+		if classfilter is None:
+			return self.deviceInstances
+		return {name: di for name, di in self.deviceInstances.items() \
+			if name.startswith(classfilter + '.')}
+
+	def get_device_instance(self, serviceName):
+		return self.deviceInstances[serviceName]
+
+class StatePublisher(object):
+	""" Listener that keeps DbusMonitor.state up to date. Only the services
+	    that changed are copied, the others are shared with the previous
+	    state. """
+	def __init__(self, monitor):
+		super(StatePublisher, self).__init__()
+		self.monitor = monitor
+		self.dirty = set()
+		self.scheduled = False
+
+	def _changed(self, service):
+		self.dirty.add(service.name)
+		if not self.scheduled:
+			self.scheduled = True
+			self.monitor.scheduler.call_soon(self.publish)
+
+	def service_added(self, service):
+		self._changed(service)
+
+	def service_removed(self, service):
+		self._changed(service)
+
+	def value_changed(self, service, path, value):
+		self._changed(service)
+
+	def publish(self):
+		self.scheduled = False
+		monitor = self.monitor
+		state = monitor.state
+		services = dict(state.services) if state is not None else {}
+		deviceInstances = dict(state.deviceInstances) if state is not None else {}
+		for name in self.dirty:
+			service = monitor.servicesByName.get(name)
+			if service is None:
+				services.pop(name, None)
+				deviceInstances.pop(name, None)
+			else:
+				services[name] = MappingProxyType({path: a.value for path, a in service.paths.items()})
+				deviceInstances[name] = service.deviceInstance
+		self.dirty.clear()
+		monitor.state = MonitorState(monitor.version, MappingProxyType(services),
+			MappingProxyType(deviceInstances))
+
+def _log_on_interval(serviceClass, path, options):
+	return isinstance(options, dict) and \
+		str(options.get('whenToLog', '')).startswith('onInterval')
+
+class AlarmRule(object):
+	""" A limit on one path of all services of a class, create these using
+	    DbusMonitor.add_alarm. An alarm is raised once the value has been
+	    above (or below) the limit for delay seconds, and cleared once it is
+	    back by more than hysteresis. """
+	def __init__(self, serviceClass, path, above, below, hysteresis, delay, callback):
+		super(AlarmRule, self).__init__()
+		self.serviceClass = serviceClass
+		self.path = path
+		self.above = above
+		self.below = below
+		self.hysteresis = hysteresis
+		self.delay = delay
+		self.callback = callback
+
+		# Timers of services waiting out the delay, and the names of the
+		# services for which the alarm is raised.
+		self.pending = {}
+		self.active = set()
+
+	def triggered(self, value):
+		if self.above is not None:
+			return value > self.above
+		return value < self.below
+
+	def cleared(self, value):
+		if self.above is not None:
+			return value <= self.above - self.hysteresis
+		return value >= self.below + self.hysteresis
+
+def _make_changes(value, text):
+	if text is notfound:
+		return ValueChanges(Value=value)
+	return {'Value': value, 'Text': text}
+
+def _get_view(views, index, key):
+	""" Returns a read-only copy of index[key]. The copy is cached until the
+	    entry for key is removed from views, which is done whenever
+	    index[key] changes, so that copies handed out never change. """
+	try:
+		return views[key]
+	except KeyError:
+		view = views[key] = MappingProxyType(dict(index.get(key, ())))
+		return view
+
+class RateLimit(object):
+	""" State kept for paths that have rate limiting options. """
+	def __init__(self, delivered):
+		super(RateLimit, self).__init__()
+		self.delivered = delivered
+		self.last = None
+		self.changes = None
+		self.timer = None
+
+class DispatchQueue(object):
+	""" Changes waiting to be passed to valueChangedCallback, at most one per
+	    (service, path). A newer change replaces a waiting one, so consumers
+	    that fall behind skip the intermediate values. Changes come out in
+	    order of priority, and in arrival order within a priority. If maxsize
+	    is given and the queue is full, the oldest entry of the lowest
+	    priority is dropped to make room, as long as that priority is lower
+	    than that of the new change. Otherwise the new change is dropped.
+	    Dropped changes are kept aside, one per (service, path), and put
+	    back as soon as there is room, so that the last value of every path
+	    is always delivered. """
+	def __init__(self, maxsize=None):
+		super(DispatchQueue, self).__init__()
+		self.queues = {}
+		self.priorities = []
+		self.overflow = defaultdict(OrderedDict)
+		self.size = 0
+		self.maxsize = maxsize
+		self.scheduled = False
+		self.maxdepth = 0
+		self.coalesced = 0
+		self.dropped = 0
+		self.dispatched = 0
+
+	def put(self, key, item, priority=PRIORITY_DEFAULT):
+		try:
+			queue = self.queues[priority]
+		except KeyError:
+			queue = self.queues[priority] = OrderedDict()
+			self.priorities = sorted(self.queues, reverse=True)
+
+		if key in queue:
+			self.coalesced += 1
+		else:
+			if self.maxsize is not None and self.size >= self.maxsize:
+				for p in reversed(self.priorities):
+					if p >= priority:
+						# Nothing less important to make room for it
+						self.dropped += 1
+						self.overflow[priority][key] = item
+						return
+					if self.queues[p]:
+						oldest, olditem = self.queues[p].popitem(last=False)
+						self.overflow[p][oldest] = olditem
+						self.size -= 1
+						self.dropped += 1
+						break
+			if self.overflow:
+				self._discard_overflow(key, priority)
+			self.size += 1
+		queue[key] = item
+		self.maxdepth = max(self.maxdepth, self.size)
+
+	def _discard_overflow(self, key, priority):
+		""" Forgets a dropped change that is replaced by a newer one. """
+		overflow = self.overflow.get(priority)
+		if overflow is not None and key in overflow:
+			del overflow[key]
+			if not overflow:
+				del self.overflow[priority]
+
+	def _refill(self):
+		""" Puts back the oldest dropped change of the highest priority. """
+		for priority in self.priorities:
+			overflow = self.overflow.get(priority)
+			if overflow:
+				key, item = overflow.popitem(last=False)
+				if not overflow:
+					del self.overflow[priority]
+				self.queues[priority][key] = item
+				self.size += 1
+				return
+
+	def get(self):
+		""" Returns the oldest (key, item) of the highest priority, raises
+		    KeyError when empty. """
+		for priority in self.priorities:
+			queue = self.queues[priority]
+			if queue:
+				self.size -= 1
+				self.dispatched += 1
+				result = queue.popitem(last=False)
+				if self.overflow:
+					self._refill()
+				return result
+		raise KeyError('queue is empty')
+
+	def __len__(self):
+		return self.size
+
+	@property
+	def stats(self):
+		return {
+			'depth': self.size,
+			'maxdepth': self.maxdepth,
+			'coalesced': self.coalesced,
+			'dropped': self.dropped,
+			'dispatched': self.dispatched
+		}
+
+class TimerWheel(object):
+	""" Hashed timing wheel. Calls callback(item) once time.monotonic()
+	    passes the deadline an item was added with, to a resolution of tick
+	    milliseconds. Adding is O(1), and there is a single timer on the
+	    scheduler, that only runs while the wheel holds items. Items cannot
+	    be removed, callback has to skip those that are no longer wanted. """
+	def __init__(self, scheduler, callback, tick=1000, size=256):
+		super(TimerWheel, self).__init__()
+		self.scheduler = scheduler
+		self.callback = callback
+		self.tick = tick
+		self.slots = [[] for _ in range(size)]
+		self.count = 0
+		self.current = 0
+		self.timer = None
+
+	def _now(self):
+		return int(time.monotonic() * 1000) // self.tick
+
+	def add(self, item, deadline):
+		if self.timer is None:
+			self.current = self._now()
+			self.timer = self.scheduler.call_later(self.tick, self._run)
+
+		t = max(int(math.ceil(deadline * 1000 / self.tick)), self.current + 1)
+		self.slots[t % len(self.slots)].append((t, item))
+		self.count += 1
+
+	def _run(self):
+		now = self._now()
+		expired = []
+		while self.current < now:
+			self.current += 1
+			slot = self.slots[self.current % len(self.slots)]
+			if slot:
+				# Entries that are more than a turn of the wheel away stay
+				expired.extend(item for t, item in slot if t <= self.current)
+				slot[:] = [e for e in slot if e[0] > self.current]
+
+		self.count -= len(expired)
+		self.timer = self.scheduler.call_later(self.tick, self._run) if self.count else None
+
+		for item in expired:
+			self.callback(item)
+
+class StaleWatch(object):
+	""" A timeout on the updates of one monitored path, see
+	    DbusMonitor.add_stale_watch. """
+	def __init__(self, serviceName, path, monitored, timeout, callback):
+		super(StaleWatch, self).__init__()
+		self.serviceName = serviceName
+		self.path = path
+		self.monitored = monitored
+		self.timeout = timeout
+		self.callback = callback
+		self.stale = False
+		self.active = True
+
+class PendingWrite(object):
+	""" A SetValue in flight with optimistic writes. Signals for the path are
+	    held back in reported while the write is in flight, and the next
+	    value to write waits in queued, replacing any earlier queued value. """
+	def __init__(self, reported):
+		super(PendingWrite, self).__init__()
+		self.reported = reported
+		self.signalled = False
+		self.handlers = []
+		self.queued = notfound
+		self.queuedHandlers = []
+
+def _run_batch(callback, batch):
+	""" Runs in the executor of an ExecutorDispatcher. Returns how many of
+	    the calls failed. """
+	failed = 0
+	for args in batch:
+		try:
+			callback(*args)
+		except Exception:
+			logger.exception("Error in offloaded valueChangedCallback")
+			failed += 1
+	return failed
+
+class ExecutorDispatcher(object):
+	""" A valueChangedCallback that runs callback in a
+	    concurrent.futures executor, so that expensive consumers do not hold
+	    up the mainloop. Changes are sent in batches of at most batchSize,
+	    with at most maxBatches in flight. Changes for a (service, path)
+	    are passed in order: while one is in flight, the next one waits, and
+	    is replaced by newer ones. Changes never wait for the executor on
+	    the mainloop, and the number waiting is bounded by the number of
+	    paths. With a ProcessPoolExecutor, callback must be picklable, such
+	    as a module level function. scheduler must be the one of the
+	    monitor. Errors in callback are logged and counted, but do not end
+	    the process like they do on the mainloop. """
+	def __init__(self, executor, callback, scheduler=None, maxBatches=4, batchSize=100):
+		super(ExecutorDispatcher, self).__init__()
+		self.executor = executor
+		self.callback = callback
+		self.scheduler = scheduler or GLibScheduler()
+		self.maxBatches = maxBatches
+		self.batchSize = batchSize
+
+		# Changes that can be sent, and those that wait for a change for the
+		# same path that is in flight, indexed by (service, path).
+		self.ready = OrderedDict()
+		self.held = {}
+		self.busy = set()
+		self.inflight = 0
+		self.scheduled = False
+
+		self.submitted = 0
+		self.completed = 0
+		self.failed = 0
+		self.coalesced = 0
+		self.maxpending = 0
+
+	def __call__(self, serviceName, objectPath, options, changes, deviceInstance):
+		key = (serviceName, objectPath)
+		pending = self.held if key in self.busy else self.ready
+		if key in pending:
+			self.coalesced += 1
+		pending[key] = (serviceName, objectPath, options, changes, deviceInstance)
+		self.maxpending = max(self.maxpending, len(self.ready) + len(self.held))
+		self._schedule()
+
+	def _schedule(self):
+		if not self.scheduled and self.ready and self.inflight < self.maxBatches:
+			self.scheduled = True
+			self.scheduler.call_soon(self._submit)
+
+	def _submit(self):
+		self.scheduled = False
+		while self.ready and self.inflight < self.maxBatches:
+			keys = []
+			batch = []
+			while self.ready and len(batch) < self.batchSize:
+				key, args = self.ready.popitem(last=False)
+				keys.append(key)
+				batch.append(args)
+			self.busy.update(keys)
+			self.inflight += 1
+			self.submitted += len(batch)
+			future = self.executor.submit(_run_batch, self.callback, batch)
+			future.add_done_callback(partial(self._done_threadsafe, keys))
+
+	def _done_threadsafe(self, keys, future):
+		# Called from an executor thread
+		self.scheduler.call_soon_threadsafe(self._done, keys, future)
+
+	def _done(self, keys, future):
+		self.inflight -= 1
+		try:
+			failed = future.result()
+		except Exception:
+			logger.exception("Offloading valueChangedCallback failed")
+			failed = len(keys)
+		self.failed += failed
+		self.completed += len(keys) - failed
+
+		for key in keys:
+			self.busy.discard(key)
+			args = self.held.pop(key, None)
+			if args is not None:
+				self.ready[key] = args
+		self._schedule()
+
+	@property
+	def stats(self):
+		return {
+			'inflight': self.inflight,
+			'pending': len(self.ready) + len(self.held),
+			'maxpending': self.maxpending,
+			'submitted': self.submitted,
+			'completed': self.completed,
+			'failed': self.failed,
+			'coalesced': self.coalesced
+		}
+
 class ScanProgress(object):
 	def __init__(self, onfinish):
 		self.services = set()
@@ -103,16 +852,65 @@ class DbusMonitor(object):
 	## Constructor
 	def __init__(self, dbusTree, valueChangedCallback=None,
 			deviceAddedCallback=None, deviceRemovedCallback=None,
-			namespace="com.victronenergy", ignoreServices=[]):
+			namespace="com.victronenergy", ignoreServices=[], scheduler=None, valueOnly=False,
+			dispatchQueueSize=None, dispatchBatchSize=100, optimisticWrites=False,
+			restartGraceTime=None, lazy=False):
 		# valueChangedCallback is the callback that we call when something has changed.
 		# def value_changed_on_dbus(dbusServiceName, dbusPath, options, changes, deviceInstance):
 		# in which changes is a tuple with GetText() and GetValue()
 		self.valueChangedCallback = valueChangedCallback
 		self.deviceAddedCallback = deviceAddedCallback
 		self.deviceRemovedCallback = deviceRemovedCallback
-		self.dbusTree = dbusTree
+		# Copy the outer level of the tree, so that adding or removing service
+		# classes later on does not modify the tree passed in by the caller.
+		self.dbusTree = dict(dbusTree)
 		self.ignoreServices = ignoreServices
 
+		# In lazy mode, the services of a class are only scanned once the
+		# class is first asked for, see activate_class. These are the classes
+		# that have not been asked for yet.
+		self._lazyClasses = set(dbusTree) if lazy else set()
+
+		# Where deferred work, such as calling valueChangedCallback, is run
+		self.scheduler = scheduler or GLibScheduler()
+
+		# In value-only mode, Text received from services is not stored or
+		# passed on. Where a text is asked for, it is made from the value.
+		self.valueOnly = valueOnly
+
+		# Changes waiting for valueChangedCallback. Without a size limit the
+		# queue is still bounded by the number of monitored paths. With one,
+		# changes that do not fit wait aside until there is room. At most
+		# dispatchBatchSize callbacks are made per mainloop iteration.
+		self._dispatchQueue = DispatchQueue(dispatchQueueSize)
+		self.dispatchBatchSize = dispatchBatchSize
+
+		# With optimistic writes, set_value_async updates the monitored value
+		# right away and keeps at most one SetValue in flight per path. The
+		# writes in flight are indexed by service name and then path.
+		self.optimisticWrites = optimisticWrites
+		self._writes = defaultdict(dict)
+
+		# When a known service loses its owner or gets a new one, it is kept
+		# for restartGraceTime milliseconds instead of being removed. Owner
+		# changes within that time restart it, and once it passes the service
+		# is either removed, or rescanned and only the changed values are
+		# passed on. Holds the timer and latest owner, indexed by service name.
+		self.restartGraceTime = restartGraceTime
+		self._restarting = {}
+
+		# Timeouts of stale watches, created when the first one is added
+		self._staleWheel = None
+
+		# The dbusTree may contain patterns next to literal paths. Literal paths
+		# are looked up directly, patterns are only tried for paths that are
+		# not in the tree, and the outcome is cached per service class.
+		self._literalPaths = {}
+		self._patterns = {}
+		self._patternMatches = defaultdict(dict)
+		for serviceClass in dbusTree:
+			self._compile_tree(serviceClass)
+
 		# Lists all tracked services. Stores name, id, device instance, value per path, and whenToLog info
 		# indexed by service name (eg. com.victronenergy.settings).
 		self.servicesByName = {}
@@ -120,11 +918,64 @@ class DbusMonitor(object):
 		# Same values as self.servicesByName, but indexed by service id (eg. :1.30)
 		self.servicesById = {}
 
-		# Keep track of services by class to speed up calls to get_service_list
+		# Keep track of services by class
 		self.servicesByClass = defaultdict(list)
 
-		# Keep track of any additional watches placed on items
-		self.serviceWatches = defaultdict(list)
+		# Service name to device instance, per class and for all services
+		# (key None), per path the services that have it, and service names
+		# indexed by (class, device instance). These are kept up to date as
+		# services come and go, so that lookups need not iterate anything.
+		# The read-only copies handed out are cached per key until it changes.
+		self._serviceLists = defaultdict(dict)
+		self._servicesByPath = defaultdict(dict)
+		self._servicesByInstance = {}
+		self._serviceListViews = {}
+		self._servicesByPathViews = {}
+
+		# Rate limiting state for paths with rate limiting options, indexed
+		# by service name and then path.
+		self._rateLimits = defaultdict(dict)
+
+		# Keep track of any additional watches placed on items, indexed by
+		# service name and then path, and the service names of the watched
+		# services indexed by service id.
+		self.serviceWatches = defaultdict(dict)
+		self._watchOwners = {}
+
+		# Aggregates over all services of a class, indexed by path
+		self._aggregates = defaultdict(list)
+
+		# Alarm rules, indexed by path
+		self._alarms = defaultdict(list)
+
+		# Groups of paths that statistics are kept of per interval
+		self._intervalGroups = []
+
+		# Objects told about every change to the monitored values
+		self._listeners = []
+
+		# Counts the batches of changes processed, and the changes to the
+		# services and paths monitored, for snapshots. While an ItemsChanged
+		# signal is processed, _inBatch is set and the version is only
+		# increased when it is done.
+		self.version = 0
+		self._layoutVersion = 0
+		self._inBatch = False
+		self._batchChanged = False
+
+		# The MonitorState for other threads, once publish_state is called,
+		# and values they asked to write, with the Future to report back on.
+		self.state = None
+		self._statePublisher = None
+		self._threadWrites = Queue()
+		self._threadWritesLock = threading.Lock()
+		self._threadWritesScheduled = False
+
+		# Derived values by name. Derived values can only depend on those
+		# added before them, so this is also the order to calculate them in.
+		self._derived = {}
+		self._derivedByPath = defaultdict(list)
+		self._derivedPending = False
 
 		# For a PC, connect to the SessionBus
 		# For a CCGX, connect to the SystemBus
@@ -159,6 +1010,56 @@ class DbusMonitor(object):
 			self.scan_dbus_service(serviceName)
 		logger.info('===== Sync scan complete =====')
 
+	def _compile_tree(self, serviceClass):
+		paths = self.dbusTree.get(serviceClass, {})
+		self._literalPaths[serviceClass] = {
+			path: options for path, options in paths.items() if not is_path_pattern(path) }
+		patterns = [(compile_path_pattern(path), options) \
+			for path, options in paths.items() if is_path_pattern(path)]
+		if patterns:
+			self._patterns[serviceClass] = patterns
+		else:
+			self._patterns.pop(serviceClass, None)
+		self._patternMatches.pop(serviceClass, None)
+
+	def match_path(self, serviceClass, path):
+		""" Returns the options of the first pattern in the dbusTree that
+		    matches path, or None if there is no such pattern. """
+		patterns = self._patterns.get(serviceClass)
+		if patterns is None:
+			return None
+
+		matches = self._patternMatches[serviceClass]
+		try:
+			return matches[path]
+		except KeyError:
+			pass
+
+		for pattern, options in patterns:
+			if pattern.fullmatch(path):
+				break
+		else:
+			options = None
+		matches[path] = options
+		return options
+
+	def _add_pattern_paths(self, service, items):
+		""" Adds a monitor for every path in items, a sequence of
+		    (path, value, text) tuples, that is not monitored yet but matches
+		    a pattern in the dbusTree. """
+		serviceClass = service.service_class
+		if serviceClass not in self._patterns:
+			return
+
+		for path, value, text in items:
+			if path in service.paths:
+				continue
+			options = self.match_path(serviceClass, path)
+			if options is not None:
+				service.set_seen(path)
+				service.paths[path] = self.make_monitor(service, path,
+					unwrap_dbus_value(value), unwrap_dbus_value(text), options)
+
 	@staticmethod
 	def make_service(serviceId, serviceName, deviceInstance):
 		""" Override this to use a different kind of service object. """
@@ -166,14 +1067,25 @@ class DbusMonitor(object):
 
 	def make_monitor(self, service, path, value, text, options):
 		""" Override this to do more things with monitoring. """
-		return MonitoredValue(unwrap_dbus_value(value), unwrap_dbus_value(text), options)
+		if self.valueOnly:
+			text = notfound
+		a = MonitoredValue(unwrap_dbus_value(value), unwrap_dbus_value(text), options)
+		if isinstance(options, dict) and options.get('history'):
+			a.history = History(options['history'])
+			a.history.append(a.timestamp, a.value)
+		return a
 
 	def dbus_name_owner_changed(self, name, oldowner, newowner):
+		if name in self.serviceWatches:
+			self._watchOwners.pop(oldowner, None)
+			if newowner != '':
+				self._watchOwners[newowner] = name
+
 		if not self.service_wanted(name):
 			return
 
 		#decouple, and process in main loop
-		GLib.idle_add(exit_on_error, self._process_name_owner_changed, name, oldowner, newowner)
+		self.scheduler.call_soon(self._process_name_owner_changed, name, oldowner, newowner)
 
 	def _process_newowner(self, name):
 		# Do a sync scan, and call deviceAddedCallback if we have it
@@ -181,28 +1093,189 @@ class DbusMonitor(object):
 			self.deviceAddedCallback(name, self.get_device_instance(name))
 
 	def _process_name_owner_changed(self, name, oldowner, newowner):
-		if newowner != '':
+		if self.restartGraceTime is not None and name in self.servicesByName:
+			self._restart_service(name, newowner)
+
+		elif newowner != '':
 			# so we found some new service. Check if we can do something with it.
 			self._process_newowner(name)
 
 		elif name in self.servicesByName:
 			# it disappeared, we need to remove it.
 			logger.info("%s disappeared from the dbus. Removing it from our lists" % name)
-			service = self.servicesByName[name]
+			self._remove_service(name)
+
+	def _restart_service(self, name, newowner):
+		service = self.servicesByName[name]
+		if self.servicesById.get(service.id) is service:
+			del self.servicesById[service.id]
+
+		restart = self._restarting.pop(name, None)
+		if restart is not None:
+			self.scheduler.cancel(restart[0])
+		else:
+			logger.info("%s changed owner, waiting for it to settle" % name)
+
+		timer = self.scheduler.call_later(self.restartGraceTime,
+			self._restart_settled, name)
+		self._restarting[name] = (timer, newowner)
+
+	def _restart_settled(self, name):
+		timer, owner = self._restarting.pop(name)
+		if owner == '':
+			logger.info("%s disappeared from the dbus. Removing it from our lists" % name)
+			self._remove_service(name)
+		else:
+			self._rescan_service(self.servicesByName[name], owner)
+
+	def _rescan_service(self, service, owner):
+		try:
+			values = self.dbusConn.call_blocking(service.name, '/', VE_INTERFACE, 'GetItems', '', [])
+		except dbus.exceptions.DBusException:
+			self._rescan_failed(service)
+		else:
+			self._rescan_done(service, owner, values)
+
+	def _rescan_failed(self, service):
+		# Scan it from scratch, as a new service
+		self._remove_service(service.name)
+		self._process_newowner(service.name)
+
+	def _rescan_done(self, service, owner, values):
+		""" Updates a service that came back within restartGraceTime from
+		    the result of GetItems. Only values that differ from those kept
+		    are passed on. """
+		if self._getitems_device_instance(service.name, values) != service.deviceInstance:
+			self._rescan_failed(service)
+			return
+
+		logger.info("%s is back, updating changed values" % service.name)
+		service.id = owner
+		self.servicesById[owner] = service
+
+		count = len(service.paths)
+		self._add_pattern_paths(service, ((path, item.get('Value', None), item.get('Text', None)) \
+			for path, item in values.items()))
+		if len(service.paths) != count:
+			self._unindex_service(service)
+			self._index_service(service)
+			self._class_changed(service.service_class)
+			self._add_interval_stats(service)
+
+		self._begin_batch()
+		try:
+			for path, a in list(service.paths.items()):
+				item = values.get(path, None)
+				if item is None:
+					# Gone from the service, which does not make it seen
+					self._store_value(service, path, a, None, None)
+					continue
+				value = unwrap_dbus_value(item.get('Value', None))
+				text = notfound if self.valueOnly else unwrap_dbus_value(item.get('Text', None))
+				self._handler_value_changes(service, path, value, text)
+		finally:
+			self._end_batch()
+
+	def _add_service(self, service):
+		self.servicesByName[service.name] = service
+		self.servicesById[service.id] = service
+		self.servicesByClass[service.service_class].append(service)
+		self._index_service(service)
+		self._class_changed(service.service_class)
+		self._evaluate_alarms(service)
+		self._add_interval_stats(service)
+		for listener in self._listeners:
+			listener.service_added(service)
+
+	def _index_service(self, service):
+		serviceClass = service.service_class
+		self._serviceLists[None][service.name] = service.deviceInstance
+		self._serviceLists[serviceClass][service.name] = service.deviceInstance
+		self._serviceListViews.pop(None, None)
+		self._serviceListViews.pop(serviceClass, None)
+		self._servicesByInstance.setdefault(
+			(serviceClass, service.deviceInstance), []).append(service.name)
+		for path in service.paths:
+			if service.seen(path):
+				self._servicesByPath[path][service.name] = service.deviceInstance
+				self._servicesByPathViews.pop(path, None)
+
+	def _unindex_service(self, service):
+		serviceClass = service.service_class
+		self._serviceLists[None].pop(service.name, None)
+		self._serviceLists[serviceClass].pop(service.name, None)
+		self._serviceListViews.pop(None, None)
+		self._serviceListViews.pop(serviceClass, None)
+		key = (serviceClass, service.deviceInstance)
+		names = self._servicesByInstance.get(key, [])
+		if service.name in names:
+			names.remove(service.name)
+			if not names:
+				del self._servicesByInstance[key]
+		for path in service.paths:
+			if service.name in self._servicesByPath.get(path, ()):
+				del self._servicesByPath[path][service.name]
+				self._servicesByPathViews.pop(path, None)
+
+	def _class_changed(self, serviceClass):
+		""" Called when services of serviceClass were added or removed, or
+		    when the paths monitored on them changed. """
+		self._layoutVersion += 1
+		self.version += 1
+		self._reset_aggregates(serviceClass)
+		self._invalidate_derived(d for d in self._derived.values() \
+			if any(c == serviceClass for c, p in d.inputs))
+
+	def _remove_service(self, name):
+		service = self.servicesByName[name]
+		if self.servicesById.get(service.id) is service:
 			del self.servicesById[service.id]
-			del self.servicesByName[name]
-			for watch in self.serviceWatches[name]:
-				watch.remove()
-			del self.serviceWatches[name]
-			self.servicesByClass[service.service_class].remove(service)
-			if self.deviceRemovedCallback is not None:
-				self.deviceRemovedCallback(name, service.deviceInstance)
+		del self.servicesByName[name]
+		self.serviceWatches.pop(name, None)
+		self._watchOwners.pop(service.id, None)
+		for limit in self._rateLimits.pop(name, {}).values():
+			if limit.timer is not None:
+				self.scheduler.cancel(limit.timer)
+		self._writes.pop(name, None)
+		for a in service.paths.values():
+			for watch in a.staleWatches or ():
+				watch.active = False
+		restart = self._restarting.pop(name, None)
+		if restart is not None:
+			self.scheduler.cancel(restart[0])
+		self._clear_alarms(service)
+		for a in service.paths.values():
+			self._remove_path_interval_stats(a)
+		for listener in self._listeners:
+			listener.service_removed(service)
+		self.servicesByClass[service.service_class].remove(service)
+		self._unindex_service(service)
+		self._class_changed(service.service_class)
+		if self.deviceRemovedCallback is not None:
+			self.deviceRemovedCallback(name, service.deviceInstance)
 
 	def service_wanted(self, serviceName):
+		serviceClass = '.'.join(serviceName.split('.')[0:3])
 		return not any(
 			serviceName.startswith(x) for x in self.ignoreServices) and (
 			serviceName.startswith('com.victronenergy.')) and (
-			'.'.join(serviceName.split('.')[0:3]) in self.dbusTree)
+			serviceClass in self.dbusTree) and (
+			serviceClass not in self._lazyClasses)
+
+	def activate_class(self, serviceClass):
+		""" In lazy mode, scans the services of serviceClass and starts
+		    following them, if that was not done yet. This happens by itself
+		    when the class is first asked for through get_value,
+		    get_service_list, track_value or add_aggregate. """
+		if serviceClass not in self._lazyClasses:
+			return
+		self._lazyClasses.discard(serviceClass)
+		for serviceName in self.wanted_service_names():
+			if serviceName.startswith(serviceClass + '.'):
+				self._process_newowner(serviceName)
+
+	def _activate_service_class(self, serviceName):
+		self.activate_class('.'.join(serviceName.split('.')[0:3]))
 
 	def wanted_service_names(self):
 		return [s for s in self.dbusConn.list_names() if self.service_wanted(s)]
@@ -267,7 +1340,7 @@ class DbusMonitor(object):
 		except:
 			pass
 
-		paths = self.dbusTree.get('.'.join(serviceName.split('.')[0:3]), None)
+		paths = self._literalPaths.get('.'.join(serviceName.split('.')[0:3]), None)
 		if paths is None:
 			return False
 
@@ -300,36 +1373,57 @@ class DbusMonitor(object):
 
 			service.paths[path] = self.make_monitor(service, path, unwrap_dbus_value(value), unwrap_dbus_value(text), options)
 
+		self._add_pattern_paths(service, (('/' + path, value, texts.get(path, None)) \
+			for path, value in values.items()))
+
 		logger.debug("Finished scanning and storing items for %s" % serviceName)
 
 		# Adjust self at the end of the scan, so we don't have an incomplete set of
 		# data if an exception occurs during the scan.
-		self.servicesByName[serviceName] = service
-		self.servicesById[serviceId] = service
-		self.servicesByClass[service.service_class].append(service)
+		self._add_service(service)
 
 		return True
 
-	def scan_dbus_service_getitems_done(self, serviceName, serviceId, values):
+	@staticmethod
+	def _getitems_device_instance(serviceName, values):
+		""" Returns the device instance from the result of GetItems, or None
+		    if there is none. """
 		# Keeping these exceptions for legacy reasons
 		if serviceName == 'com.victronenergy.settings' or serviceName == 'com.victronenergy.platform':
-			di = 0
+			return 0
 		elif serviceName.startswith('com.victronenergy.vecan.'):
-			di = 0
-		else:
-			try:
-				di = values['/DeviceInstance']['Value']
-			except KeyError:
-				logger.info("       %s was skipped because it has no device instance" % serviceName)
-				return None
-			else:
-				di = int(di)
+			return 0
+		try:
+			return int(values['/DeviceInstance']['Value'])
+		except KeyError:
+			return None
+
+	def scan_dbus_service_getitems_done(self, serviceName, serviceId, values):
+		di = self._getitems_device_instance(serviceName, values)
+		if di is None:
+			logger.info("       %s was skipped because it has no device instance" % serviceName)
+			return None
 
 		logger.info("       %s has device instance %s" % (serviceName, di))
 		service = self.make_service(serviceId, serviceName, di)
 
-		paths = self.dbusTree.get('.'.join(serviceName.split('.')[0:3]), {})
+		paths = self._literalPaths.get('.'.join(serviceName.split('.')[0:3]), {})
+		self._add_items(service, paths, values)
+
+		self._add_service(service)
+		return di
+
+	def _add_items(self, service, paths, values):
+		""" Adds monitors for paths, a dictionary of path to options, to
+		    service, using values as returned by GetItems. Paths that are
+		    already monitored only get their options updated. """
 		for path, options in paths.items():
+			if is_path_pattern(path):
+				continue
+			if path in service.paths:
+				service.paths[path].options = options
+				continue
+
 			item = values.get(path, notfound)
 			if item is notfound:
 				service.paths[path] = self.make_monitor(service, path, None, None, options)
@@ -339,77 +1433,355 @@ class DbusMonitor(object):
 				text = item.get('Text', None)
 				service.paths[path] = self.make_monitor(service, path, unwrap_dbus_value(value), unwrap_dbus_value(text), options)
 
-		self.servicesByName[serviceName] = service
-		self.servicesById[serviceId] = service
-		self.servicesByClass[service.service_class].append(service)
-		return di
+		self._add_pattern_paths(service, ((path, item.get('Value', None), item.get('Text', None)) \
+			for path, item in values.items()))
+
+	def scan_dbus_service_paths(self, service, paths):
+		""" Fetches paths, a dictionary of path to options, for a service
+		    that has already been scanned. Uses one GetItems call, and falls
+		    back to GetValue and GetText for services that don't support it. """
+		try:
+			values = self.dbusConn.call_blocking(service.name, '/', VE_INTERFACE, 'GetItems', '', [])
+		except dbus.exceptions.DBusException:
+			values = self._get_items_legacy(service.name, paths)
+		self._add_paths_done(service, paths, values)
+
+	def _add_paths_done(self, service, paths, values):
+		self._unindex_service(service)
+		self._add_items(service, paths, values)
+		self._index_service(service)
+		self._class_changed(service.service_class)
+		self._evaluate_alarms(service)
+		self._add_interval_stats(service)
+		for listener in self._listeners:
+			listener.service_added(service)
+
+	def _get_items_legacy(self, serviceName, paths):
+		""" Returns the same as GetItems would for the given paths, for
+		    services that do not implement GetItems. """
+		values = {}
+		try:
+			v = self.dbusConn.call_blocking(serviceName, '/', VE_INTERFACE, 'GetValue', '', [])
+			t = self.dbusConn.call_blocking(serviceName, '/', VE_INTERFACE, 'GetText', '', [])
+		except dbus.exceptions.DBusException:
+			pass
+		else:
+			for path, value in v.items():
+				values['/' + path] = {'Value': value, 'Text': t.get(path, None)}
+
+		for path in paths:
+			if path in values or is_path_pattern(path):
+				continue
+			try:
+				values[path] = {
+					'Value': self.dbusConn.call_blocking(serviceName, path, VE_INTERFACE, 'GetValue', '', []),
+					'Text': self.dbusConn.call_blocking(serviceName, path, VE_INTERFACE, 'GetText', '', [])}
+			except dbus.exceptions.DBusException:
+				logger.debug("%s %s does not exist (yet)" % (serviceName, path))
+		return values
+
+	def add_monitored_paths(self, serviceClass, paths):
+		""" Starts monitoring additional paths, given as a dictionary of
+		    path to options like the entries in the dbusTree. When
+		    serviceClass was not monitored yet, its services are scanned and
+		    reported through deviceAddedCallback. For services that are
+		    already known only the new paths are fetched. """
+		if serviceClass not in self.dbusTree:
+			self.dbusTree[serviceClass] = dict(paths)
+			self._compile_tree(serviceClass)
+			self._lazyClasses.discard(serviceClass)
+			for serviceName in self.wanted_service_names():
+				if '.'.join(serviceName.split('.')[0:3]) == serviceClass:
+					self._process_newowner(serviceName)
+			return
+
+		tree = self.dbusTree[serviceClass] = dict(self.dbusTree[serviceClass])
+		tree.update(paths)
+		self._compile_tree(serviceClass)
+
+		for service in list(self.servicesByClass.get(serviceClass, ())):
+			self.scan_dbus_service_paths(service, paths)
+
+	def remove_monitored_paths(self, serviceClass, paths=None):
+		""" Stops monitoring paths, an iterable of paths or patterns as used
+		    in the dbusTree. If paths is None, the whole service class is no
+		    longer monitored, and its services are removed as if they had
+		    disappeared from the bus. """
+		if serviceClass not in self.dbusTree:
+			return
+
+		if paths is None:
+			for service in list(self.servicesByClass.get(serviceClass, ())):
+				self._remove_service(service.name)
+			del self.dbusTree[serviceClass]
+			self._lazyClasses.discard(serviceClass)
+			self._literalPaths.pop(serviceClass, None)
+			self._patterns.pop(serviceClass, None)
+			self._patternMatches.pop(serviceClass, None)
+			self.servicesByClass.pop(serviceClass, None)
+			return
+
+		tree = self.dbusTree[serviceClass] = dict(self.dbusTree[serviceClass])
+		for path in paths:
+			tree.pop(path, None)
+		self._compile_tree(serviceClass)
+
+		literals = self._literalPaths[serviceClass]
+		for service in self.servicesByClass.get(serviceClass, ()):
+			self._unindex_service(service)
+			removed = [path for path in service.paths
+				if path not in literals and self.match_path(serviceClass, path) is None]
+			self._clear_alarms(service, removed)
+			limits = self._rateLimits.get(service.name, {})
+			for path in removed:
+				limit = limits.pop(path, None)
+				if limit is not None and limit.timer is not None:
+					self.scheduler.cancel(limit.timer)
+				a = service.paths[path]
+				for watch in a.staleWatches or ():
+					watch.active = False
+				self._remove_path_interval_stats(a)
+				service.remove_path(path)
+			self._index_service(service)
+			for listener in self._listeners:
+				listener.service_added(service)
+		self._class_changed(serviceClass)
 
 	def handler_item_changes(self, items, senderId):
 		if not isinstance(items, dict):
 			return
 
-		try:
-			service = self.servicesById[senderId]
-		except KeyError:
+		service = self.servicesById.get(senderId, None)
+		watches = self._get_watches(senderId)
+		if service is None and watches is None:
 			# senderId isn't there, which means it hasn't been scanned yet.
 			return
 
-		for path, changes in items.items():
-			try:
-				v = unwrap_dbus_value(changes['Value'])
-			except (KeyError, TypeError):
-				continue
-
-			try:
-				t = changes['Text']
-			except KeyError:
-				t = str(v)
-			self._handler_value_changes(service, path, v, t)
+		self._begin_batch()
+		try:
+			for path, changes in items.items():
+				try:
+					v = unwrap_dbus_value(changes['Value'])
+				except (KeyError, TypeError):
+					continue
+
+				t = notfound if self.valueOnly else changes.get('Text', notfound)
+				if service is not None:
+					self._handler_value_changes(service, path, v, t)
+				if watches is not None:
+					self._execute_watches(watches, path, v, t)
+		finally:
+			self._end_batch()
+
+	def _begin_batch(self):
+		self._inBatch = True
+
+	def _end_batch(self):
+		self._inBatch = False
+		if self._batchChanged:
+			self._batchChanged = False
+			self.version += 1
 
 	def handler_value_changes(self, changes, path, senderId):
 		# If this properyChange does not involve a value, our work is done.
 		if 'Value' not in changes:
 			return
 
-		try:
-			service = self.servicesById[senderId]
-		except KeyError:
+		service = self.servicesById.get(senderId, None)
+		watches = self._get_watches(senderId)
+		if service is None and watches is None:
 			# senderId isn't there, which means it hasn't been scanned yet.
 			return
 
 		v = unwrap_dbus_value(changes['Value'])
-		# Some services don't send Text with their PropertiesChanged events.
-		try:
-			t = changes['Text']
-		except KeyError:
-			t = str(v)
-		self._handler_value_changes(service, path, v, t)
+		# Some services don't send Text with their PropertiesChanged events,
+		# in which case it is made from the value only when it is needed.
+		t = notfound if self.valueOnly else changes.get('Text', notfound)
+		if service is not None:
+			self._handler_value_changes(service, path, v, t)
+		if watches is not None:
+			self._execute_watches(watches, path, v, t)
+
+	def _get_watches(self, senderId):
+		name = self._watchOwners.get(senderId, None)
+		if name is None:
+			return None
+		return self.serviceWatches.get(name, None)
+
+	def _execute_watches(self, watches, path, value, text):
+		for callback in watches.get(path, ()):
+			callback(_make_changes(value, text))
 
 	def _handler_value_changes(self, service, path, value, text):
 		try:
 			a = service.paths[path]
 		except KeyError:
-			# path isn't there, which means it hasn't been scanned yet.
-			return
+			# path isn't there, which means it hasn't been scanned yet, unless
+			# it is a new path that matches one of the patterns in the tree.
+			if not self._patterns:
+				return
+			options = self.match_path(service.service_class, path)
+			if options is None:
+				return
+			a = service.paths[path] = self.make_monitor(service, path, None, None, options)
+			self._layoutVersion += 1
+			if self._intervalGroups:
+				self._add_path_interval_stats(service, path, a,
+					self._intervalGroups, time.monotonic())
+
+		if not service.seen(path):
+			service.set_seen(path)
+			self._servicesByPath[path][service.name] = service.deviceInstance
+			self._servicesByPathViews.pop(path, None)
+
+		a.timestamp = time.monotonic()
+		if a.staleWatches:
+			self._refresh_stale_watches(a)
+
+		# While an optimistic write is in flight, the written value is kept
+		# and what the service reports is applied when the write completes.
+		if self._writes:
+			writes = self._writes.get(service.name)
+			if writes and path in writes:
+				write = writes[path]
+				write.reported = (value, text)
+				write.signalled = True
+				return
 
-		service.set_seen(path)
+		self._store_value(service, path, a, value, text)
 
+	def _store_value(self, service, path, a, value, text):
 		# First update our store to the new value
 		if a.value == value:
 			return
 
+		oldvalue = a.value
 		a.value = value
 		a.text = text
+		if self._inBatch:
+			a.version = self.version + 1
+			self._batchChanged = True
+		else:
+			self.version += 1
+			a.version = self.version
+		if a.history is not None:
+			a.history.append(time.monotonic(), value)
+		if a.intervalStats:
+			now = time.monotonic()
+			for stats in a.intervalStats:
+				stats.update(value, now)
+		for listener in self._listeners:
+			listener.value_changed(service, path, value)
+
+		aggregates = self._aggregates.get(path)
+		if aggregates:
+			self._update_aggregates(aggregates, service, value)
+
+		alarms = self._alarms.get(path)
+		if alarms:
+			serviceClass = service.service_class
+			for rule in alarms:
+				if rule.serviceClass == serviceClass:
+					self._evaluate_alarm(rule, service.name, value)
+
+		derived = self._derivedByPath.get(path)
+		if derived:
+			serviceClass = service.service_class
+			self._invalidate_derived(d for d in derived if (serviceClass, path) in d.inputs)
 
 		# And do the rest of the processing in on the mainloop
 		if self.valueChangedCallback is not None:
-			GLib.idle_add(exit_on_error, self._execute_value_changes, service.name, path, {
-				'Value': value, 'Text': text}, a.options)
+			changes = _make_changes(value, text)
+			if isinstance(a.options, dict) and not rate_limit_options.isdisjoint(a.options):
+				self._rate_limit(service, path, changes, a.options, oldvalue)
+			else:
+				self._queue_value_changes(service.name, path, changes, a.options)
+
+	def _rate_limit(self, service, path, changes, options, oldvalue):
+		""" Applies the minInterval, debounce and deadband options of a
+		    path. Changes that are held back are replaced by newer ones, and
+		    the last one is always passed on when its time comes. """
+		try:
+			limit = self._rateLimits[service.name][path]
+		except KeyError:
+			limit = self._rateLimits[service.name][path] = RateLimit(oldvalue)
+
+		value = changes['Value']
+		deadband = options.get('deadband', None)
+		if deadband is not None and _is_number(value) and _is_number(limit.delivered) and \
+				abs(value - limit.delivered) < deadband:
+			# Too close to what the callback already has, also drop whatever
+			# was pending, as that is no longer the latest value.
+			limit.changes = None
+			return
+
+		now = time.monotonic()
+		delay = 0
+		interval = options.get('minInterval', None)
+		if interval is not None and limit.last is not None:
+			delay = max(0, limit.last + interval / 1000.0 - now)
+		debounce = options.get('debounce', None)
+		if debounce is not None:
+			delay = max(delay, debounce / 1000.0)
+
+		if delay == 0 and limit.timer is None:
+			limit.last = now
+			limit.delivered = value
+			self._queue_value_changes(service.name, path, changes, options)
+			return
+
+		limit.changes = changes
+		if debounce is not None and limit.timer is not None:
+			self.scheduler.cancel(limit.timer)
+			limit.timer = None
+		if limit.timer is None:
+			limit.timer = self.scheduler.call_later(int(math.ceil(delay * 1000)),
+				self._execute_rate_limited, service.name, path, limit, options)
+
+	def _execute_rate_limited(self, serviceName, objectPath, limit, options):
+		limit.timer = None
+		changes, limit.changes = limit.changes, None
+		if changes is not None:
+			limit.last = time.monotonic()
+			limit.delivered = changes['Value']
+			self._queue_value_changes(serviceName, objectPath, changes, options)
+
+	def _queue_value_changes(self, serviceName, objectPath, changes, options):
+		queue = self._dispatchQueue
+		priority = options.get('priority', PRIORITY_DEFAULT) if isinstance(options, dict) \
+			else PRIORITY_DEFAULT
+		queue.put((serviceName, objectPath), (changes, options), priority)
+		if not queue.scheduled:
+			queue.scheduled = True
+			self.scheduler.call_soon(self._dispatch_value_changes)
+
+	def _dispatch_value_changes(self):
+		queue = self._dispatchQueue
+		queue.scheduled = False
+		for i in range(self.dispatchBatchSize):
+			try:
+				(serviceName, objectPath), (changes, options) = queue.get()
+			except KeyError:
+				break
+			self._execute_value_changes(serviceName, objectPath, changes, options)
+
+		# Leave the rest for the next iteration, so that the mainloop gets to
+		# process incoming signals in between.
+		if len(queue) and not queue.scheduled:
+			queue.scheduled = True
+			self.scheduler.call_soon(self._dispatch_value_changes)
+
+	def get_dispatch_stats(self):
+		""" Returns a dictionary with the current depth of the queue of
+		    changes waiting for valueChangedCallback, the largest depth seen,
+		    and how many changes were coalesced, dropped and dispatched. """
+		return self._dispatchQueue.stats
 
 	def _execute_value_changes(self, serviceName, objectPath, changes, options):
 		# double check that the service still exists, as it might have
 		# disappeared between scheduling-for and executing this function.
-		if serviceName not in self.servicesByName:
+		# Same for the callback.
+		if serviceName not in self.servicesByName or self.valueChangedCallback is None:
 			return
 
 		self.valueChangedCallback(serviceName, objectPath,
@@ -424,7 +1796,11 @@ class DbusMonitor(object):
 	def get_value(self, serviceName, objectPath, default_value=None):
 		service = self.servicesByName.get(serviceName, None)
 		if service is None:
-			return default_value
+			if self._lazyClasses:
+				self._activate_service_class(serviceName)
+				service = self.servicesByName.get(serviceName, None)
+			if service is None:
+				return default_value
 
 		value = service.paths.get(objectPath, None)
 		if value is None or value.value is None:
@@ -454,6 +1830,76 @@ class DbusMonitor(object):
 		except KeyError:
 			return False
 
+	# Returns the seconds since the path was last scanned or signalled, or
+	# None when it is not monitored.
+	def get_age(self, serviceName, objectPath):
+		try:
+			a = self.servicesByName[serviceName].paths[objectPath]
+		except KeyError:
+			return None
+		return time.monotonic() - a.timestamp
+
+	def get_history(self, serviceName, objectPath, start=None, end=None):
+		""" Returns two array.array('d') of the time.monotonic() timestamps
+		    and values of a path with the history option, oldest first,
+		    optionally limited to the samples from start up to and including
+		    end. Both support the buffer protocol, so numpy.frombuffer can
+		    wrap them without a copy. Returns None if the path keeps no
+		    history. """
+		try:
+			history = self.servicesByName[serviceName].paths[objectPath].history
+		except KeyError:
+			return None
+		return None if history is None else history.get(start, end)
+
+	stale_resolution = 1000
+
+	def add_stale_watch(self, serviceName, objectPath, timeout, callback):
+		""" Calls callback(serviceName, objectPath, True) when the monitored
+		    path was not signalled for timeout seconds, and
+		    callback(serviceName, objectPath, False) when it is signalled again
+		    after that. Timeouts are checked every stale_resolution
+		    milliseconds. Raises KeyError if the path is not monitored.
+		    Returns the watch, pass it to remove_stale_watch to stop. The
+		    watch ends when the service disappears, or the path is no longer
+		    monitored. """
+		a = self.servicesByName[serviceName].paths[objectPath]
+		if self._staleWheel is None:
+			self._staleWheel = TimerWheel(self.scheduler, self._stale_watch_expired,
+				self.stale_resolution)
+
+		watch = StaleWatch(serviceName, objectPath, a, timeout, callback)
+		if a.staleWatches is None:
+			a.staleWatches = []
+		a.staleWatches.append(watch)
+		self._staleWheel.add(watch, a.timestamp + timeout)
+		return watch
+
+	def remove_stale_watch(self, watch):
+		watch.active = False
+		try:
+			watch.monitored.staleWatches.remove(watch)
+		except ValueError:
+			pass
+
+	def _stale_watch_expired(self, watch):
+		if not watch.active:
+			return
+		deadline = watch.monitored.timestamp + watch.timeout
+		if deadline > time.monotonic():
+			# Signalled in the mean time, check again later
+			self._staleWheel.add(watch, deadline)
+		else:
+			watch.stale = True
+			watch.callback(watch.serviceName, watch.path, True)
+
+	def _refresh_stale_watches(self, a):
+		for watch in a.staleWatches:
+			if watch.stale:
+				watch.stale = False
+				self._staleWheel.add(watch, a.timestamp + watch.timeout)
+				watch.callback(watch.serviceName, watch.path, False)
+
 	# Sets the value for a certain servicename and path, returns the return value of the D-Bus SetValue
 	# method. If the underlying item does not exist (the service does not exist, or the objectPath was not
 	# registered) the function will return -1
@@ -478,30 +1924,118 @@ class DbusMonitor(object):
 		service = self.servicesByName.get(serviceName, None)
 		if service is not None:
 			if objectPath in service.paths:
-				self.dbusConn.call_async(serviceName, objectPath,
-					dbus_interface=VE_INTERFACE,
-					method='SetValue', signature=None,
-					args=[wrap_dbus_value(value)],
-					reply_handler=reply_handler, error_handler=error_handler)
+				if self.optimisticWrites:
+					self._write_optimistic(service, objectPath, value,
+						reply_handler, error_handler)
+				else:
+					self.dbusConn.call_async(serviceName, objectPath,
+						dbus_interface=VE_INTERFACE,
+						method='SetValue', signature=None,
+						args=[wrap_dbus_value(value)],
+						reply_handler=reply_handler, error_handler=error_handler)
 				return
 
 		if error_handler is not None:
 			error_handler(TypeError('Service or path not found, '
 						'service=%s, path=%s' % (serviceName, objectPath)))
 
+	def _write_optimistic(self, service, path, value, reply_handler, error_handler):
+		""" Stores value as if the service reported it, and writes it. If a
+		    write to the path is already in flight, value is written once that
+		    completes, unless it is replaced by a newer value first. The
+		    handlers of replaced values are called with the outcome of the
+		    write that replaced them. """
+		a = service.paths[path]
+		writes = self._writes[service.name]
+		write = writes.get(path)
+		if write is None:
+			write = writes[path] = PendingWrite((a.value, a._text))
+			write.handlers.append((reply_handler, error_handler))
+			self._send_write(service, path, write, value)
+		else:
+			write.queued = value
+			write.queuedHandlers.append((reply_handler, error_handler))
+
+		self._store_value(service, path, a, value, notfound)
+
+	def _send_write(self, service, path, write, value):
+		self.dbusConn.call_async(service.name, path,
+			dbus_interface=VE_INTERFACE,
+			method='SetValue', signature=None,
+			args=[wrap_dbus_value(value)],
+			reply_handler=partial(self._write_done, service, path, write),
+			error_handler=partial(self._write_failed, service, path, write))
+
+	def _write_done(self, service, path, write, result):
+		if result != 0:
+			# The service rejected the value, roll back like on error
+			self._write_failed(service, path, write, ValueError('SetValue '
+				'rejected with %d, service=%s, path=%s' % (result, service.name, path)))
+			return
+		handlers = write.handlers
+		self._next_write(service, path, write, write.signalled)
+		for reply_handler, error_handler in handlers:
+			if reply_handler is not None:
+				reply_handler(result)
+
+	def _write_failed(self, service, path, write, exc):
+		handlers = write.handlers
+		self._next_write(service, path, write, True)
+		for reply_handler, error_handler in handlers:
+			if error_handler is not None:
+				error_handler(exc)
+
+	def _next_write(self, service, path, write, restore):
+		""" Sends the queued value, if any. Otherwise ends the write, and if
+		    restore is set, stores the value last reported by the service. On
+		    error that rolls back the optimistic value. """
+		writes = self._writes.get(service.name)
+		if writes is None or writes.get(path) is not write:
+			# The service disappeared in the mean time
+			for reply_handler, error_handler in write.queuedHandlers:
+				if error_handler is not None:
+					error_handler(TypeError('Service or path not found, '
+						'service=%s, path=%s' % (service.name, path)))
+			return
+
+		if write.queued is not notfound:
+			value = write.queued
+			write.handlers = write.queuedHandlers
+			write.queued = notfound
+			write.queuedHandlers = []
+			self._send_write(service, path, write, value)
+			return
+
+		del writes[path]
+		if not writes:
+			del self._writes[service.name]
+		a = service.paths.get(path)
+		if restore and a is not None:
+			value, text = write.reported
+			self._store_value(service, path, a, value, text)
+
 	# returns a dictionary, keys are the servicenames, value the instances
 	# optionally use the classfilter to get only a certain type of services, for
 	# example com.victronenergy.battery.
+	# The dictionary is read-only, and does not change once returned. It is
+	# cached until services of the class come or go, use dict() for a copy
+	# that can be modified.
 	def get_service_list(self, classfilter=None):
-		if classfilter is None:
-			return { servicename: service.deviceInstance \
-				for servicename, service in self.servicesByName.items() }
-
-		if classfilter not in self.servicesByClass:
-			return {}
-
-		return { service.name: service.deviceInstance \
-			for service in self.servicesByClass[classfilter] }
+		if self._lazyClasses:
+			for serviceClass in list(self._lazyClasses) if classfilter is None else (classfilter,):
+				self.activate_class(serviceClass)
+		return _get_view(self._serviceListViews, self._serviceLists, classfilter)
+
+	# Returns the name of the service of the given class with the given device
+	# instance, or None if there is no such service.
+	def get_service_by_instance(self, serviceClass, deviceInstance):
+		names = self._servicesByInstance.get((serviceClass, deviceInstance), None)
+		return names[0] if names else None
+
+	# Returns the services that have the given path, in the same form as
+	# get_service_list. Only monitored paths are included.
+	def get_services_with_path(self, objectPath):
+		return _get_view(self._servicesByPathViews, self._servicesByPath, objectPath)
 
 	def get_device_instance(self, serviceName):
 		return self.servicesByName[serviceName].deviceInstance
@@ -510,35 +2044,397 @@ class DbusMonitor(object):
 		""" A DbusMonitor can watch specific service/path combos for changes
 		    so that it is not fully reliant on the global handler_value_changes
 		    in this class. Additional watches are deleted automatically when
-		    the service disappears from dbus. """
-		cb = partial(callback, *args, **kwargs)
-
-		def root_tracker(items):
-			# Check if objectPath in dict
-			try:
-				v = items[objectPath]
-				_v = unwrap_dbus_value(v['Value'])
-			except (KeyError, TypeError):
-				return # not in this dict
-
-			try:
-				t = v['Text']
-			except KeyError:
-				cb({'Value': _v })
+		    the service disappears from dbus.
+
+		    Watches are called from the same signal handlers that update the
+		    monitored values, so they do not add match rules of their own. The
+		    path does not have to be in the dbusTree, and the service does not
+		    have to be monitored, but it must be in the namespace passed to the
+		    constructor for its owner to be followed. """
+		if self._lazyClasses:
+			self._activate_service_class(serviceName)
+
+		if serviceName not in self.serviceWatches:
+			service = self.servicesByName.get(serviceName, None)
+			if service is not None:
+				self._watchOwners[service.id] = serviceName
+			else:
+				try:
+					self._watchOwners[self.dbusConn.get_name_owner(serviceName)] = serviceName
+				except dbus.exceptions.DBusException:
+					pass # Not on the bus yet, dbus_name_owner_changed picks it up
+
+		self.serviceWatches[serviceName].setdefault(objectPath, []).append(
+			partial(callback, *args, **kwargs))
+
+	def add_aggregate(self, serviceClass, objectPath, kind, callback=None):
+		""" Keeps a sum, min, max, count or mean of objectPath over all
+		    services of serviceClass, updated as values change and services
+		    come and go. The path must be monitored. Returns an Aggregate,
+		    read its value attribute for the current result. If given,
+		    callback(aggregate) is called from the mainloop whenever the
+		    result changes. Asking for the same aggregate twice returns the
+		    same object. """
+		self.activate_class(serviceClass)
+
+		for aggregate in self._aggregates[objectPath]:
+			if aggregate.serviceClass == serviceClass and aggregate.kind == kind:
+				break
+		else:
+			aggregate = Aggregate(serviceClass, objectPath, kind)
+			aggregate.reset(self._aggregate_values(aggregate))
+			aggregate.notified = aggregate.value
+			self._aggregates[objectPath].append(aggregate)
+
+		if callback is not None:
+			aggregate.callbacks.append(callback)
+		return aggregate
+
+	def remove_aggregate(self, aggregate):
+		aggregates = self._aggregates.get(aggregate.path, [])
+		if aggregate in aggregates:
+			aggregates.remove(aggregate)
+			if not aggregates:
+				del self._aggregates[aggregate.path]
+
+	def _aggregate_values(self, aggregate):
+		for service in self.servicesByClass.get(aggregate.serviceClass, ()):
+			a = service.paths.get(aggregate.path)
+			if a is not None:
+				yield service.name, a.value
+
+	def _reset_aggregates(self, serviceClass):
+		for aggregates in self._aggregates.values():
+			for aggregate in aggregates:
+				if aggregate.serviceClass == serviceClass:
+					aggregate.reset(self._aggregate_values(aggregate))
+					self._aggregate_changed(aggregate)
+
+	def _update_aggregates(self, aggregates, service, value):
+		serviceClass = service.service_class
+		for aggregate in aggregates:
+			if aggregate.serviceClass == serviceClass:
+				aggregate.update(service.name, value)
+				self._aggregate_changed(aggregate)
+
+	def _aggregate_changed(self, aggregate):
+		# Notify once per mainloop iteration, no matter how many of the
+		# underlying values changed.
+		if aggregate.callbacks and not aggregate.pending:
+			aggregate.pending = True
+			self.scheduler.call_soon(self._execute_aggregate_changes, aggregate)
+
+	def _execute_aggregate_changes(self, aggregate):
+		aggregate.pending = False
+		value = aggregate.value
+		if value == aggregate.notified:
+			return
+		aggregate.notified = value
+		for callback in list(aggregate.callbacks):
+			callback(aggregate)
+
+	def add_derived_value(self, name, function, inputs, callback=None):
+		""" Adds a value that is calculated by function(monitor) from
+		    other values. inputs lists what it depends on: (serviceClass, path)
+		    tuples for monitored paths, and names of derived values, which
+		    must have been added before. The function is only called again
+		    when one of the inputs changed, or when services of an input class
+		    come or go, and at most once per mainloop iteration. Derived values
+		    that depend on others are calculated after them. If given,
+		    callback(name, value) is called when the result changes. """
+		if name in self._derived:
+			raise ValueError("Derived value %s already exists" % name)
+
+		derived = DerivedValue(name, function)
+		for i in inputs:
+			if isinstance(i, str):
+				try:
+					depends = self._derived[i]
+				except KeyError:
+					raise ValueError("Derived value %s depends on unknown derived value %s" % (name, i))
+				derived.depends.append(depends)
+			else:
+				derived.inputs.add(tuple(i))
+
+		for depends in derived.depends:
+			depends.dependents.append(derived)
+		for serviceClass, path in derived.inputs:
+			if derived not in self._derivedByPath[path]:
+				self._derivedByPath[path].append(derived)
+		if callback is not None:
+			derived.callbacks.append(callback)
+
+		self._derived[name] = derived
+		derived.value = function(self)
+		return derived
+
+	def remove_derived_value(self, name):
+		derived = self._derived[name]
+		if derived.dependents:
+			raise ValueError("Derived value %s is used by %s" % (name,
+				', '.join(d.name for d in derived.dependents)))
+
+		del self._derived[name]
+		for depends in derived.depends:
+			depends.dependents.remove(derived)
+		for serviceClass, path in derived.inputs:
+			l = self._derivedByPath.get(path, [])
+			if derived in l:
+				l.remove(derived)
+				if not l:
+					del self._derivedByPath[path]
+
+	def get_derived_value(self, name, default_value=None):
+		derived = self._derived.get(name, None)
+		if derived is None or derived.value is None:
+			return default_value
+		return derived.value
+
+	def track_derived_value(self, name, callback, *args, **kwargs):
+		""" Calls callback(name, value) whenever the derived value
+		    changes. """
+		self._derived[name].callbacks.append(partial(callback, *args, **kwargs))
+
+	def _invalidate_derived(self, derived):
+		for d in derived:
+			d.dirty = True
+			if not self._derivedPending:
+				self._derivedPending = True
+				self.scheduler.call_soon(self._execute_derived_changes)
+
+	def _execute_derived_changes(self):
+		self._derivedPending = False
+		for derived in list(self._derived.values()):
+			if not derived.dirty:
+				continue
+			derived.dirty = False
+			value = derived.function(self)
+			if value == derived.value:
+				continue
+			derived.value = value
+			for d in derived.dependents:
+				d.dirty = True
+			for callback in list(derived.callbacks):
+				callback(derived.name, value)
+
+	def add_alarm(self, serviceClass, objectPath, callback, above=None, below=None,
+			hysteresis=0, delay=0):
+		""" Raises an alarm for a service of serviceClass when objectPath has
+		    been above (or below) the given limit for delay seconds, and
+		    clears it once the value is back by more than hysteresis.
+		    callback(serviceName, objectPath, active) is called when an alarm
+		    is raised or cleared. Rules are only evaluated when their path
+		    changes, and there is only a timer while a rule waits out its
+		    delay. Returns an AlarmRule, use get_alarms for the services for
+		    which it is raised. """
+		if (above is None) == (below is None):
+			raise ValueError('Pass either above or below')
+
+		rule = AlarmRule(serviceClass, objectPath, above, below, hysteresis, delay, callback)
+		self._alarms[objectPath].append(rule)
+		for service in self.servicesByClass.get(serviceClass, ()):
+			a = service.paths.get(objectPath)
+			if a is not None:
+				self._evaluate_alarm(rule, service.name, a.value)
+		return rule
+
+	def remove_alarm(self, rule):
+		""" Stops evaluating rule. Raised alarms are dropped without calling
+		    the callback. """
+		rules = self._alarms.get(rule.path, [])
+		if rule in rules:
+			rules.remove(rule)
+			if not rules:
+				del self._alarms[rule.path]
+		for timer in rule.pending.values():
+			self.scheduler.cancel(timer)
+		rule.pending.clear()
+		rule.active.clear()
+
+	# Returns the names of the services for which rule is raised
+	def get_alarms(self, rule):
+		return frozenset(rule.active)
+
+	def _evaluate_alarm(self, rule, serviceName, value):
+		if not _is_number(value):
+			# An invalid value neither raises nor clears an alarm
+			timer = rule.pending.pop(serviceName, None)
+			if timer is not None:
+				self.scheduler.cancel(timer)
+		elif serviceName in rule.active:
+			if rule.cleared(value):
+				rule.active.discard(serviceName)
+				rule.callback(serviceName, rule.path, False)
+		elif rule.triggered(value):
+			if serviceName in rule.pending:
+				return
+			if rule.delay:
+				rule.pending[serviceName] = self.scheduler.call_later(
+					rule.delay * 1000, self._alarm_delay_done, rule, serviceName)
 			else:
-				cb({'Value': _v, 'Text': t})
-
-		# Track changes on the path, and also on root
-		self.serviceWatches[serviceName].extend((
-			self.dbusConn.add_signal_receiver(cb,
-				dbus_interface='com.victronenergy.BusItem',
-				signal_name='PropertiesChanged',
-				path=objectPath, bus_name=serviceName),
-			self.dbusConn.add_signal_receiver(root_tracker,
-				dbus_interface='com.victronenergy.BusItem',
-				signal_name='ItemsChanged',
-				path="/", bus_name=serviceName),
-		))
+				self._alarm_delay_done(rule, serviceName)
+		else:
+			timer = rule.pending.pop(serviceName, None)
+			if timer is not None:
+				self.scheduler.cancel(timer)
+
+	def _alarm_delay_done(self, rule, serviceName):
+		rule.pending.pop(serviceName, None)
+		rule.active.add(serviceName)
+		rule.callback(serviceName, rule.path, True)
+
+	def _evaluate_alarms(self, service):
+		""" Evaluates the rules for a service that was added, or that got
+		    more paths. """
+		if not self._alarms:
+			return
+		serviceClass = service.service_class
+		for path, a in service.paths.items():
+			for rule in self._alarms.get(path, ()):
+				if rule.serviceClass == serviceClass:
+					self._evaluate_alarm(rule, service.name, a.value)
+
+	def _clear_alarms(self, service, paths=None):
+		""" Clears the alarms of a service that disappeared, or only those on
+		    paths when given, for paths that are no longer monitored. Alarms
+		    that were raised are reported as cleared. """
+		if not self._alarms:
+			return
+		for path in (service.paths if paths is None else paths):
+			for rule in self._alarms.get(path, ()):
+				timer = rule.pending.pop(service.name, None)
+				if timer is not None:
+					self.scheduler.cancel(timer)
+				if service.name in rule.active:
+					rule.active.discard(service.name)
+					rule.callback(service.name, rule.path, False)
+
+	def add_interval_stats(self, interval, callback, select=None):
+		""" Keeps the minimum, maximum, time weighted mean, last value and
+		    number of changes of a group of paths over intervals of interval
+		    seconds. The statistics are updated on every change, and at the
+		    end of each interval callback(records) is called once, with
+		    records a dictionary of IntervalSummary tuples indexed by
+		    (serviceName, path). The group holds the paths for which
+		    select(serviceClass, path, options) returns True. By default that
+		    is those with a whenToLog option starting with 'onInterval'.
+		    Returns the group, pass it to remove_interval_stats to stop. """
+		group = IntervalGroup(interval, callback, select or _log_on_interval)
+		self._intervalGroups.append(group)
+		for service in self.servicesByName.values():
+			self._add_interval_stats(service, (group,))
+		group.timer = self.scheduler.call_later(interval * 1000,
+			self._interval_done, group)
+		return group
+
+	def remove_interval_stats(self, group):
+		if group not in self._intervalGroups:
+			return
+		self._intervalGroups.remove(group)
+		self.scheduler.cancel(group.timer)
+		for (serviceName, path), stats in group.stats.items():
+			a = self.servicesByName[serviceName].paths.get(path)
+			if a is not None and stats in (a.intervalStats or ()):
+				a.intervalStats.remove(stats)
+		group.stats.clear()
+
+	def _add_interval_stats(self, service, groups=None):
+		""" Adds the paths of a service to the groups that select them, if
+		    they are not in there yet. """
+		groups = self._intervalGroups if groups is None else groups
+		if not groups:
+			return
+		now = time.monotonic()
+		for path, a in service.paths.items():
+			self._add_path_interval_stats(service, path, a, groups, now)
+
+	def _add_path_interval_stats(self, service, path, a, groups, now):
+		key = (service.name, path)
+		for group in groups:
+			if key not in group.stats and group.select(service.service_class, path, a.options):
+				stats = group.stats[key] = IntervalStats(group, key, a.value, now)
+				if a.intervalStats is None:
+					a.intervalStats = []
+				a.intervalStats.append(stats)
+
+	def _remove_path_interval_stats(self, a):
+		for stats in a.intervalStats or ():
+			stats.group.stats.pop(stats.key, None)
+		a.intervalStats = None
+
+	def _interval_done(self, group):
+		group.timer = self.scheduler.call_later(group.interval * 1000,
+			self._interval_done, group)
+		now = time.monotonic()
+		records = {}
+		for key, stats in group.stats.items():
+			records[key] = stats.summary(now)
+			stats.reset(stats.last, now)
+		group.callback(records)
+
+	def snapshot_set(self, items):
+		""" Returns a SnapshotSet for items, an iterable of (serviceName,
+		    path) pairs. Its read() returns a Snapshot of the values as they
+		    stood after the last signal that was completely processed, and
+		    changed_since(snapshot.version) tells cheaply whether anything in
+		    the set moved since. Snapshots taken from the signal handlers
+		    themselves, such as from listeners, can include the signal being
+		    processed. """
+		return SnapshotSet(self, items)
+
+	def get_snapshot(self, items):
+		""" Returns a Snapshot of the values of items, see snapshot_set. """
+		return SnapshotSet(self, items).read()
+
+	def publish_state(self):
+		""" Keeps self.state up to date with a MonitorState: an immutable
+		    copy of all monitored values that other threads can read without
+		    locking. A new one is made once per mainloop iteration in which
+		    values changed, and replaces the previous one in one assignment.
+		    Returns the current state. """
+		if self._statePublisher is None:
+			self._statePublisher = StatePublisher(self)
+			self.add_listener(self._statePublisher)
+			self._statePublisher.publish()
+		return self.state
+
+	def set_value_threadsafe(self, serviceName, objectPath, value):
+		""" Like set_value_async, but may be called from any thread. Returns
+		    a concurrent.futures.Future with the result of SetValue. """
+		future = Future()
+		self._threadWrites.put((serviceName, objectPath, value, future))
+		with self._threadWritesLock:
+			if not self._threadWritesScheduled:
+				self._threadWritesScheduled = True
+				self.scheduler.call_soon_threadsafe(self._execute_thread_writes)
+		return future
+
+	def _execute_thread_writes(self):
+		with self._threadWritesLock:
+			self._threadWritesScheduled = False
+		while True:
+			try:
+				serviceName, objectPath, value, future = self._threadWrites.get_nowait()
+			except Empty:
+				break
+			if future.set_running_or_notify_cancel():
+				self.set_value_async(serviceName, objectPath, value,
+					reply_handler=future.set_result, error_handler=future.set_exception)
+
+	def add_listener(self, listener):
+		""" Tells listener about every change to the monitored values,
+		    right from the signal handlers: listener.service_added(service)
+		    for services that are added, and again when their paths change,
+		    listener.service_removed(service) for those that go, and
+		    listener.value_changed(service, path, value) for new values. The
+		    services known so far are passed to service_added right away. """
+		self._listeners.append(listener)
+		for service in list(self.servicesByName.values()):
+			listener.service_added(service)
+
+	def remove_listener(self, listener):
+		if listener in self._listeners:
+			self._listeners.remove(listener)
 
 	def set_device_added_callback(self, callback):
 		""" This allows changing the callback to something else, or to
@@ -584,6 +2480,10 @@ class AsyncDbusMonitor(DbusMonitor):
 			progress.add(serviceName)
 			self.get_name_owner_async(progress, serviceName)
 
+		# Nothing to scan, so nothing will ever complete
+		if not progress.services and callback is not None:
+			self.scheduler.call_soon(callback, [])
+
 	def scan_async_error(error, progress, serviceName, exc):
 		logger.error("Ignoring %s because of error while scanning:" % (serviceName))
 		logger.error(str(exc))
@@ -605,6 +2505,12 @@ class AsyncDbusMonitor(DbusMonitor):
 			partial(self.get_items_async_error, progress, serviceName, owner))
 
 	def get_items_async_done(self, progress, serviceName, owner, values):
+		known = self.servicesByName.get(serviceName)
+		if known is not None and known.id == owner:
+			# Scanned by another scan in the mean time
+			progress.complete(serviceName)
+			return
+
 		di = self.scan_dbus_service_getitems_done(serviceName, owner, values)
 		if di is not None:
 			if self.deviceAddedCallback is not None:
@@ -618,6 +2524,39 @@ class AsyncDbusMonitor(DbusMonitor):
 		# Store item, so it can be scanned later
 		progress.error(serviceName)
 
+	def _rescan_service(self, service, owner):
+		self.dbusConn.call_async(service.name, '/', VE_INTERFACE,
+			'GetItems', '', [],
+			partial(self._rescan_async_done, service, owner),
+			partial(self._rescan_async_error, service))
+
+	def _rescan_async_done(self, service, owner, values):
+		# The service might have gone again in the mean time
+		if self.servicesByName.get(service.name) is service and \
+				service.name not in self._restarting:
+			self._rescan_done(service, owner, values)
+
+	def _rescan_async_error(self, service, exc):
+		if self.servicesByName.get(service.name) is service and \
+				service.name not in self._restarting:
+			self._rescan_failed(service)
+
+	def scan_dbus_service_paths(self, service, paths):
+		self.dbusConn.call_async(service.name, '/', VE_INTERFACE,
+			'GetItems', '', [],
+			partial(self.scan_paths_async_done, service, paths),
+			partial(self.scan_paths_async_error, service, paths))
+
+	def scan_paths_async_done(self, service, paths, values):
+		# The service might have disappeared in the mean time
+		if self.servicesByName.get(service.name) is service:
+			self._add_paths_done(service, paths, values)
+
+	def scan_paths_async_error(self, service, paths, exc):
+		if self.servicesByName.get(service.name) is service:
+			logger.info("GetItems failed on %s, trying legacy methods" % service.name)
+			self._add_paths_done(service, paths, self._get_items_legacy(service.name, paths))
+
 
 # ====== ALL CODE BELOW THIS LINE IS PURELY FOR DEVELOPING THIS CLASS ======
 
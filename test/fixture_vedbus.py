@@ -58,6 +58,14 @@ def main(argv):
 		dbusObjects['gettextcallback'] = VeDbusItemExport(dbusConn, '/Gettextcallback',
 			'10', gettextcallback=gettext, writeable=True)
 
+		dbusObjects['textformat'] = VeDbusItemExport(dbusConn, '/Textformat', 12.345, textformat='%.1fV')
+		dbusObjects['textformat braces'] = VeDbusItemExport(dbusConn, '/TextformatBraces', 1.5,
+			textformat='{:.2f} A', writeable=True)
+
+		dbusObjects['notext'] = VeDbusItemExport(dbusConn, '/NoText', 2.5, writeable=True, sendtext=False)
+		dbusObjects['notext with cb'] = VeDbusItemExport(dbusConn, '/NoTextGettextcallback',
+			'10', gettextcallback=gettext, writeable=True, sendtext=False)
+
 		mainloop = GLib.MainLoop()
 		print("up and running")
 		sys.stdout.flush()
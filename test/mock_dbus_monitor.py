@@ -1,6 +1,7 @@
 import dbus
 from collections import defaultdict
 from functools import partial
+from dbusmonitor import compile_path_pattern, is_path_pattern
 
 # Simulation a DbusMonitor object, without using the D-Bus (intended for unit tests). Instead of changes values
 # on the D-Bus you can use the set_value function. set_value will automatically expand the service list. Note
@@ -37,7 +38,7 @@ class MockDbusMonitor(object):
         service = self._services.get(serviceName)
         if service is None:
             return None
-        if objectPath not in self._tree[_class_name(serviceName)]:
+        if not _path_in_tree(self._tree[_class_name(serviceName)], objectPath):
             return None
         item = service.get(objectPath)
         if item is None:
@@ -48,7 +49,7 @@ class MockDbusMonitor(object):
     def exists(self, serviceName, objectPath):
         if serviceName not in self._services:
             return False
-        if objectPath not in self._tree[_class_name(serviceName)]:
+        if not _path_in_tree(self._tree[_class_name(serviceName)], objectPath):
             return False
         return True
 
@@ -69,12 +70,22 @@ class MockDbusMonitor(object):
                 r[servicename] = None if item is None else item.get_value()
         return r
 
+    def get_service_by_instance(self, serviceClass, deviceInstance):
+        for servicename, instance in self.get_service_list(serviceClass).items():
+            if instance == deviceInstance:
+                return servicename
+        return None
+
+    def get_services_with_path(self, objectPath):
+        return {servicename: instance for servicename, instance in self.get_service_list().items()
+            if objectPath in self._seen[servicename]}
+
     def add_value(self, service, path, value):
         class_name = _class_name(service)
         s = self._tree.get(class_name, None)
         if s is None:
             raise Exception('service not found')
-        if self._checkPaths and path not in s:
+        if self._checkPaths and not _path_in_tree(s, path):
             raise Exception('Path not found: {}{} (check dbusTree passed to __init__)'.format(service, path))
         s = self._services.setdefault(service, {})
         s[path] = MockImportItem(value)
@@ -135,6 +146,17 @@ class MockDbusMonitor(object):
     def track_value(self, serviceName, objectPath, callback, *args, **kwargs):
         self._watches[serviceName][objectPath] = partial(callback, *args, **kwargs)
 
+    def add_monitored_paths(self, serviceClass, paths):
+        self._tree.setdefault(serviceClass, set()).update(paths)
+
+    def remove_monitored_paths(self, serviceClass, paths=None):
+        if paths is None:
+            for service in [s for s in self._services if _class_name(s) == serviceClass]:
+                self.remove_service(service)
+            self._tree.pop(serviceClass, None)
+        else:
+            self._tree.get(serviceClass, set()).difference_update(paths)
+
     def set_device_added_callback(self, callback):
         self._device_added_callback = callback
 
@@ -169,3 +191,11 @@ class MockImportItem(object):
 
 def _class_name(service):
     return '.'.join(service.split('.')[:3])
+
+
+# The dbusTree may contain glob patterns or compiled regular expressions next to literal paths,
+# these match paths the same way as in the real DbusMonitor.
+def _path_in_tree(tree, path):
+    if path in tree:
+        return True
+    return any(compile_path_pattern(p).fullmatch(path) for p in tree if is_path_pattern(p))
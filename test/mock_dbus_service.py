@@ -1,13 +1,15 @@
 # Simulates the busService object without using the D-Bus (intended for unit tests). Data usually stored in
 # D-Bus items is now stored in memory.
 class MockDbusService(object):
-    def __init__(self, servicename):
+    def __init__(self, servicename, sendtext=True):
         self._dbusobjects = {}
         self._callbacks = {}
         self._service_name = servicename
+        self.sendtext = sendtext
 
+    # sendtext and textformat only affect the signals on the D-Bus, so they are accepted and ignored.
     def add_path(self, path, value, description="", writeable=False, onchangecallback=None,
-                 gettextcallback=None, itemtype=None):
+                 gettextcallback=None, itemtype=None, sendtext=None, textformat=None):
         self._dbusobjects[path] = value
         if onchangecallback is not None:
             self._callbacks[path] = onchangecallback
@@ -0,0 +1,1165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Python
+import asyncio
+import math
+import os
+import re
+import sys
+import threading
+import types
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import dbus
+
+# Local
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+import dbusmonitor
+from dbusmonitor import DbusMonitor, DispatchQueue, ExecutorDispatcher, History, IntervalSummary, \
+	TimerWheel, compile_path_pattern, is_path_pattern, PRIORITY_HIGH, PRIORITY_LOW
+from mock_dbus_monitor import MockDbusMonitor
+from ve_asyncio import AsyncioDbusMonitor
+from ve_utils import unwrap_dbus_value
+
+class StubBus(object):
+	""" Stands in for both D-Bus connections of a DbusMonitor. Services are
+	    added with add_service, signals are sent with emit_* and asynchronous
+	    calls wait in calls until they are answered with reply or fail. """
+	def __init__(self):
+		self.services = {}
+		self.receivers = []
+		self.calls = []
+		self.writes = []
+		self.nextId = 1
+
+	def add_service(self, name, items):
+		""" items maps paths to values, the texts are made from those. """
+		owner = ':1.%d' % self.nextId
+		self.nextId += 1
+		self.services[name] = (owner, dict(items))
+		return owner
+
+	def remove_service(self, name):
+		owner, items = self.services.pop(name)
+		return owner
+
+	def add_signal_receiver(self, handler, **kwargs):
+		self.receivers.append((handler, kwargs))
+
+	def list_names(self):
+		return list(self.services)
+
+	def get_name_owner(self, name):
+		try:
+			return self.services[name][0]
+		except KeyError:
+			raise dbus.exceptions.DBusException('No owner',
+				name='org.freedesktop.DBus.Error.NameHasNoOwner')
+
+	def _items(self, name):
+		try:
+			return self.services[name][1]
+		except KeyError:
+			raise dbus.exceptions.DBusException('Unknown service',
+				name='org.freedesktop.DBus.Error.ServiceUnknown')
+
+	def call_blocking(self, name, path, interface, method, signature, args):
+		items = self._items(name)
+		if method == 'GetItems':
+			return {p: {'Value': v, 'Text': str(v)} for p, v in items.items()}
+		if method == 'SetValue':
+			self.writes.append((name, path, unwrap_dbus_value(args[0])))
+			return 0
+		if path in items:
+			return items[path] if method == 'GetValue' else str(items[path])
+		raise dbus.exceptions.DBusException('Unknown object',
+			name='org.freedesktop.DBus.Error.UnknownObject')
+
+	def call_async(self, name, path, interface=None, method=None, signature=None,
+			args=None, reply_handler=None, error_handler=None, **kwargs):
+		self.calls.append((name, path, method, args, reply_handler, error_handler))
+
+	def reply(self, result=0):
+		""" Answers the oldest asynchronous call. """
+		name, path, method, args, reply_handler, error_handler = self.calls.pop(0)
+		reply_handler(result)
+
+	def fail(self):
+		name, path, method, args, reply_handler, error_handler = self.calls.pop(0)
+		error_handler(dbus.exceptions.DBusException('Failed',
+			name='org.freedesktop.DBus.Error.Failed'))
+
+	def answer(self):
+		""" Answers the asynchronous calls until there are none left, as
+		    the services would. """
+		while self.calls:
+			name, path, method, args, reply_handler, error_handler = self.calls.pop(0)
+			try:
+				if method == 'GetNameOwner':
+					result = self.get_name_owner(args[0])
+				else:
+					result = self.call_blocking(name, path, None, method, None, args)
+			except dbus.exceptions.DBusException as e:
+				error_handler(e)
+			else:
+				reply_handler(result)
+
+	def _emit(self, signal, *args, **kwargs):
+		for handler, options in list(self.receivers):
+			if options.get('signal_name') == signal:
+				handler(*args, **{options[k]: v for k, v in kwargs.items() if k in options})
+
+	def emit_value(self, name, path, value):
+		owner, items = self.services[name]
+		items[path] = value
+		self._emit('PropertiesChanged', {'Value': value, 'Text': str(value)},
+			path_keyword=path, sender_keyword=owner)
+
+	def emit_items(self, name, values):
+		owner, items = self.services[name]
+		items.update(values)
+		self._emit('ItemsChanged', {p: {'Value': v, 'Text': str(v)} for p, v in values.items()},
+			sender_keyword=owner)
+
+	def emit_owner_changed(self, name, oldowner, newowner):
+		self._emit('NameOwnerChanged', name, oldowner, newowner)
+
+class StubScheduler(object):
+	""" Runs deferred work when the test says so. now is the time in seconds,
+	    which also stands in for time.monotonic in the monitor. """
+	def __init__(self):
+		self.now = 1000.0
+		self.pending = []
+		self.counter = 0
+
+	def call_soon(self, callback, *args):
+		return self.call_later(0, callback, *args)
+
+	def call_later(self, delay, callback, *args):
+		self.counter += 1
+		handle = [self.now + delay / 1000.0, self.counter, callback, args]
+		self.pending.append(handle)
+		return handle
+
+	call_soon_threadsafe = call_soon
+
+	def cancel(self, handle):
+		if handle in self.pending:
+			self.pending.remove(handle)
+
+	def run(self, seconds=0):
+		""" Advances the time by seconds, running whatever becomes due. """
+		end = self.now + seconds
+		while True:
+			due = [h for h in self.pending if h[0] <= end]
+			if not due:
+				break
+			handle = min(due)
+			self.pending.remove(handle)
+			self.now = max(self.now, handle[0])
+			handle[2](*handle[3])
+		self.now = end
+
+class MonitorTestCase(unittest.TestCase):
+	battery = 'com.victronenergy.battery.ttyO1'
+	vebus = 'com.victronenergy.vebus.ttyO2'
+	tree = {
+		'com.victronenergy.battery': {
+			'/DeviceInstance': {},
+			'/Soc': {},
+			'/Dc/0/Voltage': {},
+		},
+		'com.victronenergy.vebus': {
+			'/DeviceInstance': {},
+			'/Mode': {},
+			'/Ac/Out/L1/P': {},
+		},
+	}
+
+	def setUp(self):
+		self.bus = StubBus()
+		self.scheduler = StubScheduler()
+		clock = types.SimpleNamespace(monotonic=lambda: self.scheduler.now)
+		for target, attribute, value in (
+				(dbusmonitor, 'SessionBus', lambda: self.bus),
+				(dbusmonitor, 'SystemBus', lambda: self.bus),
+				(dbus, 'SessionBus', lambda: self.bus),
+				(dbus, 'SystemBus', lambda: self.bus),
+				(dbusmonitor, 'time', clock)):
+			patcher = mock.patch.object(target, attribute, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		self.bus.add_service(self.battery, {'/DeviceInstance': 512, '/Soc': 50,
+			'/Dc/0/Voltage': 12.5})
+		self.bus.add_service(self.vebus, {'/DeviceInstance': 276, '/Mode': 3,
+			'/Ac/Out/L1/P': 100})
+		self.changes = []
+		self.added = []
+		self.removed = []
+
+	def value_changed(self, serviceName, path, options, changes, deviceInstance):
+		self.changes.append((serviceName, path, changes['Value']))
+
+	def device_added(self, serviceName, deviceInstance):
+		self.added.append((serviceName, deviceInstance))
+
+	def device_removed(self, serviceName, deviceInstance):
+		self.removed.append((serviceName, deviceInstance))
+
+	def monitor(self, tree=None, **kwargs):
+		kwargs.setdefault('scheduler', self.scheduler)
+		return DbusMonitor(self.tree if tree is None else tree,
+			valueChangedCallback=self.value_changed,
+			deviceAddedCallback=self.device_added,
+			deviceRemovedCallback=self.device_removed, **kwargs)
+
+class DispatchQueueTests(unittest.TestCase):
+	def test_priority_and_coalescing(self):
+		q = DispatchQueue()
+		q.put('a', 1)
+		q.put('b', 2, PRIORITY_LOW)
+		q.put('c', 3, PRIORITY_HIGH)
+		q.put('a', 4)
+		self.assertEqual([q.get() for i in range(len(q))], [('c', 3), ('a', 4), ('b', 2)])
+		self.assertRaises(KeyError, q.get)
+		self.assertEqual(q.stats, {'depth': 0, 'maxdepth': 3, 'coalesced': 1,
+			'dropped': 0, 'dispatched': 3})
+
+	def test_full_drops_lower_priority(self):
+		q = DispatchQueue(2)
+		q.put('l', 1, PRIORITY_LOW)
+		q.put('d', 2)
+		q.put('h', 3, PRIORITY_HIGH)
+		self.assertEqual([q.get(), q.get(), q.get()], [('h', 3), ('d', 2), ('l', 1)])
+		self.assertEqual(q.stats['dropped'], 1)
+
+	def test_full_drops_new_item(self):
+		q = DispatchQueue(2)
+		q.put('h1', 1, PRIORITY_HIGH)
+		q.put('h2', 2, PRIORITY_HIGH)
+		q.put('l', 3, PRIORITY_LOW)
+		q.put('h3', 4, PRIORITY_HIGH)
+		self.assertEqual([q.get(), q.get()], [('h1', 1), ('h2', 2)])
+		self.assertEqual(q.stats['dropped'], 2)
+
+		# Dropped changes come back once there is room
+		self.assertEqual([q.get(), q.get()], [('h3', 4), ('l', 3)])
+		self.assertRaises(KeyError, q.get)
+
+	def test_full_keeps_last_value(self):
+		q = DispatchQueue(1)
+		q.put('a', 1)
+		q.put('b', 2)
+		q.put('b', 3)
+		q.put('c', 4)
+		self.assertEqual(q.get(), ('a', 1))
+		q.put('b', 5)
+		q.put('c', 6)
+		self.assertEqual([q.get(), q.get()], [('b', 5), ('c', 6)])
+		self.assertRaises(KeyError, q.get)
+
+class PatternTests(MonitorTestCase):
+	tree = {
+		'com.victronenergy.battery': {
+			'/DeviceInstance': {},
+			'/Soc': {},
+			'/Pv/*/V': {'code': 'PV'},
+			'/Alarms/[HL]*': {},
+			re.compile(r'/Cell/\d+/V'): {'code': 'C'},
+		},
+	}
+
+	def setUp(self):
+		super(PatternTests, self).setUp()
+		self.bus.services[self.battery][1].update({'/Pv/0/V': 10, '/Pv/0/I': 1,
+			'/Alarms/High': 0})
+		self.m = self.monitor()
+
+	def test_match_path(self):
+		serviceClass = 'com.victronenergy.battery'
+		self.assertEqual(self.m.match_path(serviceClass, '/Pv/3/V'), {'code': 'PV'})
+		self.assertEqual(self.m.match_path(serviceClass, '/Pv/3/I'), None)
+		self.assertEqual(self.m.match_path(serviceClass, '/Pv/3/4/V'), None)
+		self.assertEqual(self.m.match_path(serviceClass, '/Alarms/Low'), {})
+		self.assertEqual(self.m.match_path('com.victronenergy.vebus', '/Mode'), None)
+		self.assertEqual(self.m.match_path(serviceClass, '/Cell/12/V'), {'code': 'C'})
+		self.assertEqual(self.m.match_path(serviceClass, '/Cell/12/Vx'), None)
+		self.assertTrue(is_path_pattern(re.compile('/Soc')))
+		self.assertFalse(is_path_pattern('/Soc'))
+		self.assertTrue(compile_path_pattern('/Ac/L[123]/P').match('/Ac/L2/P'))
+
+	def test_scan(self):
+		self.assertEqual(self.m.get_value(self.battery, '/Pv/0/V'), 10)
+		self.assertEqual(self.m.get_value(self.battery, '/Alarms/High'), 0)
+		self.assertTrue(self.m.seen(self.battery, '/Pv/0/V'))
+		self.assertFalse(self.m.seen(self.battery, '/Pv/0/I'))
+
+	def test_new_path(self):
+		self.bus.emit_value(self.battery, '/Pv/1/V', 20)
+		self.bus.emit_value(self.battery, '/Pv/1/I', 2)
+		self.scheduler.run()
+		self.assertEqual(self.m.get_value(self.battery, '/Pv/1/V'), 20)
+		self.assertEqual(self.m.get_value(self.battery, '/Pv/1/I'), None)
+		self.assertEqual(self.changes, [(self.battery, '/Pv/1/V', 20)])
+		self.assertEqual(dict(self.m.get_services_with_path('/Pv/1/V')), {self.battery: 512})
+
+class MockMonitorTests(unittest.TestCase):
+	def test_patterns(self):
+		m = MockDbusMonitor({'com.victronenergy.battery': {'/Pv/*/V': {},
+			re.compile(r'/Cell/\d+/V'): {}}})
+		service = 'com.victronenergy.battery.ttyO1'
+		m.add_value(service, '/Pv/0/V', 10)
+		m.add_value(service, '/Cell/1/V', 3.3)
+		self.assertEqual(m.get_value(service, '/Pv/0/V'), 10)
+		self.assertRaises(Exception, m.add_value, service, '/Pv/0/X/V', 1)
+		self.assertRaises(Exception, m.add_value, service, '/Cell/1/Vx', 1)
+
+class RuntimePathTests(MonitorTestCase):
+	def setUp(self):
+		super(RuntimePathTests, self).setUp()
+		self.m = self.monitor()
+
+	def test_add_paths(self):
+		self.bus.services[self.battery][1]['/Dc/0/Current'] = 3
+		listener = mock.Mock()
+		self.m.add_listener(listener)
+		self.m.add_monitored_paths('com.victronenergy.battery', {'/Dc/0/Current': {}})
+		self.assertEqual(self.m.get_value(self.battery, '/Dc/0/Current'), 3)
+		self.assertEqual(listener.service_added.call_count, 3)
+
+		self.bus.emit_value(self.battery, '/Dc/0/Current', 4)
+		self.assertEqual(self.m.get_value(self.battery, '/Dc/0/Current'), 4)
+		listener.value_changed.assert_called_once_with(
+			self.m.servicesByName[self.battery], '/Dc/0/Current', 4)
+
+	def test_add_class(self):
+		solar = 'com.victronenergy.solarcharger.ttyO3'
+		self.bus.add_service(solar, {'/DeviceInstance': 0, '/Yield/Power': 200})
+		self.m.add_monitored_paths('com.victronenergy.solarcharger', {'/Yield/Power': {}})
+		self.assertEqual(self.m.get_value(solar, '/Yield/Power'), 200)
+		self.assertEqual(self.added, [(solar, 0)])
+
+	def test_remove_paths(self):
+		self.m.remove_monitored_paths('com.victronenergy.battery', ['/Dc/0/Voltage'])
+		self.assertEqual(self.m.get_value(self.battery, '/Dc/0/Voltage'), None)
+		self.assertNotIn(self.battery, self.m.get_services_with_path('/Dc/0/Voltage'))
+		self.bus.emit_value(self.battery, '/Dc/0/Voltage', 13)
+		self.scheduler.run()
+		self.assertEqual(self.changes, [])
+
+	def test_remove_class(self):
+		self.m.remove_monitored_paths('com.victronenergy.vebus')
+		self.assertEqual(self.removed, [(self.vebus, 276)])
+		self.assertEqual(dict(self.m.get_service_list()), {self.battery: 512})
+		self.assertFalse(self.m.service_wanted(self.vebus))
+
+class IndexTests(MonitorTestCase):
+	def setUp(self):
+		super(IndexTests, self).setUp()
+		self.m = self.monitor()
+
+	def test_lookups(self):
+		services = self.m.get_service_list()
+		batteries = self.m.get_service_list('com.victronenergy.battery')
+		withMode = self.m.get_services_with_path('/Mode')
+		self.assertEqual(dict(services), {self.battery: 512, self.vebus: 276})
+		self.assertEqual(dict(batteries), {self.battery: 512})
+		self.assertEqual(dict(withMode), {self.vebus: 276})
+		self.assertEqual(self.m.get_service_by_instance('com.victronenergy.battery', 512), self.battery)
+		self.assertEqual(self.m.get_service_by_instance('com.victronenergy.battery', 276), None)
+
+		# What was handed out does not change, later calls see the changes
+		owner = self.bus.remove_service(self.vebus)
+		self.bus.emit_owner_changed(self.vebus, owner, '')
+		self.scheduler.run()
+		self.assertEqual(dict(services), {self.battery: 512, self.vebus: 276})
+		self.assertEqual(dict(withMode), {self.vebus: 276})
+		self.assertEqual(dict(self.m.get_service_list()), {self.battery: 512})
+		self.assertEqual(dict(self.m.get_services_with_path('/Mode')), {})
+		self.assertEqual(self.removed, [(self.vebus, 276)])
+
+		self.bus.add_service(self.vebus, {'/DeviceInstance': 277})
+		self.bus.emit_owner_changed(self.vebus, '', self.bus.get_name_owner(self.vebus))
+		self.scheduler.run()
+		self.assertEqual(dict(self.m.get_service_list()), {self.battery: 512, self.vebus: 277})
+		self.assertEqual(dict(self.m.get_services_with_path('/Mode')), {})
+		self.assertEqual(self.added, [(self.vebus, 277)])
+
+		self.bus.emit_value(self.vebus, '/Mode', 3)
+		self.assertEqual(dict(self.m.get_services_with_path('/Mode')), {self.vebus: 277})
+
+	def test_cached(self):
+		services = self.m.get_service_list('com.victronenergy.battery')
+		self.assertIs(self.m.get_service_list('com.victronenergy.battery'), services)
+		with self.assertRaises(TypeError):
+			services[self.vebus] = 276
+
+class LazyScanTests(MonitorTestCase):
+	def test_lazy(self):
+		m = self.monitor(lazy=True)
+		self.assertEqual(m.servicesByName, {})
+		self.assertEqual(m.get_value(self.battery, '/Soc'), 50)
+		self.assertNotIn(self.vebus, m.servicesByName)
+		self.assertEqual(dict(m.get_service_list()), {self.battery: 512, self.vebus: 276})
+
+	def test_new_service_of_lazy_class(self):
+		m = self.monitor(lazy=True)
+		other = 'com.victronenergy.battery.ttyO3'
+		self.bus.emit_owner_changed(other, '', self.bus.add_service(other,
+			{'/DeviceInstance': 513, '/Soc': 80}))
+		self.scheduler.run()
+		self.assertEqual(m.servicesByName, {})
+		self.assertEqual(dict(m.get_service_list('com.victronenergy.battery')),
+			{self.battery: 512, other: 513})
+
+class WatchTests(MonitorTestCase):
+	def setUp(self):
+		super(WatchTests, self).setUp()
+		self.m = self.monitor()
+		self.watched = []
+
+	def watch(self, serviceName, path):
+		self.m.track_value(serviceName, path, self.watched.append)
+
+	def test_track_value(self):
+		self.watch(self.battery, '/Soc')
+		self.watch(self.battery, '/Unmonitored')
+		self.bus.emit_value(self.battery, '/Soc', 51)
+		self.bus.emit_items(self.battery, {'/Unmonitored': 1})
+		self.assertEqual([c['Value'] for c in self.watched], [51, 1])
+
+	def test_other_service(self):
+		settings = 'com.victronenergy.settings'
+		self.bus.add_service(settings, {'/Settings/X': 1})
+		self.watch(settings, '/Settings/X')
+		self.bus.emit_value(settings, '/Settings/X', 2)
+		self.assertEqual([c['Value'] for c in self.watched], [2])
+		self.assertNotIn(settings, self.m.servicesByName)
+
+	def test_service_removed(self):
+		self.watch(self.battery, '/Soc')
+		owner = self.bus.remove_service(self.battery)
+		self.bus.emit_owner_changed(self.battery, owner, '')
+		self.scheduler.run()
+		self.assertNotIn(self.battery, self.m.serviceWatches)
+
+class LazyTextTests(MonitorTestCase):
+	def value_changed(self, serviceName, path, options, changes, deviceInstance):
+		self.changes.append(changes)
+
+	def test_text_made_on_demand(self):
+		m = self.monitor(valueOnly=True)
+		self.bus.emit_value(self.battery, '/Soc', 51)
+		self.scheduler.run()
+		changes, = self.changes
+		self.assertEqual(len(changes), 2)
+		self.assertEqual(dict(changes), {'Value': 51, 'Text': '51'})
+		self.assertEqual(changes.copy(), {'Value': 51, 'Text': '51'})
+		self.assertEqual(sorted(changes), ['Text', 'Value'])
+		self.assertEqual(m.get_value(self.battery, '/Soc'), 51)
+
+class AggregateTests(MonitorTestCase):
+	other = 'com.victronenergy.battery.ttyO3'
+
+	def setUp(self):
+		super(AggregateTests, self).setUp()
+		self.bus.add_service(self.other, {'/DeviceInstance': 513, '/Soc': 70})
+		self.m = self.monitor()
+		self.notified = []
+
+	def aggregate(self, kind):
+		return self.m.add_aggregate('com.victronenergy.battery', '/Soc', kind,
+			lambda a: self.notified.append(a.value))
+
+	def test_kinds(self):
+		self.assertEqual(self.aggregate('sum').value, 120)
+		self.assertEqual(self.aggregate('min').value, 50)
+		self.assertEqual(self.aggregate('max').value, 70)
+		self.assertEqual(self.aggregate('count').value, 2)
+		self.assertEqual(self.aggregate('mean').value, 60)
+		self.assertRaises(ValueError, self.aggregate, 'median')
+		self.assertIs(self.aggregate('sum'), self.m.add_aggregate('com.victronenergy.battery', '/Soc', 'sum'))
+
+	def test_updates(self):
+		total = self.aggregate('sum')
+		maximum = self.m.add_aggregate('com.victronenergy.battery', '/Soc', 'max')
+		self.bus.emit_value(self.battery, '/Soc', 60)
+		self.bus.emit_value(self.battery, '/Soc', 55)
+		self.bus.emit_value(self.other, '/Soc', None)
+		self.scheduler.run()
+		self.assertEqual(self.notified, [55])
+		self.assertEqual(maximum.value, 55)
+
+		owner = self.bus.remove_service(self.battery)
+		self.bus.emit_owner_changed(self.battery, owner, '')
+		self.scheduler.run()
+		self.assertEqual(total.value, None)
+		self.assertEqual(self.notified, [55, None])
+
+		self.m.remove_aggregate(total)
+		self.bus.emit_value(self.other, '/Soc', 10)
+		self.scheduler.run()
+		self.assertEqual(self.notified, [55, None])
+
+class DerivedValueTests(MonitorTestCase):
+	def setUp(self):
+		super(DerivedValueTests, self).setUp()
+		self.m = self.monitor()
+		self.notified = []
+		self.calls = 0
+
+	def soc(self, m):
+		self.calls += 1
+		return m.get_value(self.battery, '/Soc')
+
+	def test_derived(self):
+		self.m.add_derived_value('soc', self.soc, [('com.victronenergy.battery', '/Soc')])
+		self.m.add_derived_value('double', lambda m: 2 * m.get_derived_value('soc', 0), ['soc'],
+			lambda name, value: self.notified.append((name, value)))
+		self.assertEqual(self.m.get_derived_value('double'), 100)
+
+		self.bus.emit_value(self.battery, '/Soc', 51)
+		self.bus.emit_value(self.battery, '/Soc', 52)
+		self.bus.emit_value(self.vebus, '/Mode', 4)
+		self.scheduler.run()
+		self.assertEqual(self.m.get_derived_value('soc'), 52)
+		self.assertEqual(self.notified, [('double', 104)])
+		self.assertEqual(self.calls, 2)
+
+		self.assertRaises(ValueError, self.m.remove_derived_value, 'soc')
+		self.m.remove_derived_value('double')
+		self.m.remove_derived_value('soc')
+		self.assertEqual(self.m.get_derived_value('soc', 'x'), 'x')
+
+	def test_errors(self):
+		self.m.add_derived_value('soc', self.soc, [('com.victronenergy.battery', '/Soc')])
+		self.assertRaises(ValueError, self.m.add_derived_value, 'soc', self.soc, [])
+		self.assertRaises(ValueError, self.m.add_derived_value, 'x', self.soc, ['unknown'])
+
+	def test_services_change(self):
+		self.m.add_derived_value('count', lambda m: len(m.get_service_list('com.victronenergy.battery')),
+			[('com.victronenergy.battery', '/Soc')], lambda name, value: self.notified.append(value))
+		other = 'com.victronenergy.battery.ttyO3'
+		self.bus.emit_owner_changed(other, '', self.bus.add_service(other,
+			{'/DeviceInstance': 513, '/Soc': 80}))
+		self.scheduler.run()
+		self.assertEqual(self.notified, [2])
+
+class RateLimitTests(MonitorTestCase):
+	def monitor_with(self, **options):
+		tree = {'com.victronenergy.battery': {'/DeviceInstance': {}, '/Soc': options}}
+		return self.monitor(tree)
+
+	def emit(self, *values):
+		for value in values:
+			self.bus.emit_value(self.battery, '/Soc', value)
+
+	def test_min_interval(self):
+		m = self.monitor_with(minInterval=1000)
+		self.emit(51)
+		self.scheduler.run()
+		self.emit(52, 53)
+		self.scheduler.run(0.5)
+		self.assertEqual(self.changes, [(self.battery, '/Soc', 51)])
+		self.scheduler.run(0.5)
+		self.assertEqual(self.changes, [(self.battery, '/Soc', 51), (self.battery, '/Soc', 53)])
+		# Trailing values are queued like any other
+		self.assertEqual(m.get_dispatch_stats()['dispatched'], 2)
+
+	def test_debounce(self):
+		self.monitor_with(debounce=500)
+		self.emit(51)
+		self.scheduler.run(0.4)
+		self.emit(52)
+		self.scheduler.run(0.4)
+		self.assertEqual(self.changes, [])
+		self.scheduler.run(0.1)
+		self.assertEqual(self.changes, [(self.battery, '/Soc', 52)])
+
+	def test_deadband(self):
+		self.monitor_with(deadband=2)
+		self.emit(51, 53, 54)
+		self.scheduler.run()
+		self.assertEqual(self.changes, [(self.battery, '/Soc', 53)])
+
+	def test_path_no_longer_monitored(self):
+		m = self.monitor_with(minInterval=1000)
+		self.emit(51)
+		self.scheduler.run()
+		self.emit(52)
+		m.remove_monitored_paths('com.victronenergy.battery', ['/Soc'])
+		self.scheduler.run(2)
+		self.assertEqual(self.changes, [(self.battery, '/Soc', 51)])
+		self.assertEqual(self.scheduler.pending, [])
+
+	def test_trailing_priority(self):
+		tree = {
+			'com.victronenergy.battery': {'/DeviceInstance': {},
+				'/Soc': {'minInterval': 1000, 'priority': PRIORITY_LOW}},
+			'com.victronenergy.vebus': {'/DeviceInstance': {},
+				'/Mode': {'priority': PRIORITY_HIGH}},
+		}
+		self.monitor(tree)
+		self.emit(51)
+		self.scheduler.run()
+		self.emit(52)
+		self.scheduler.now += 1
+		self.bus.emit_value(self.vebus, '/Mode', 4)
+		self.scheduler.run()
+		self.assertEqual(self.changes[1:], [(self.vebus, '/Mode', 4), (self.battery, '/Soc', 52)])
+
+class OptimisticWriteTests(MonitorTestCase):
+	def setUp(self):
+		super(OptimisticWriteTests, self).setUp()
+		self.m = self.monitor(optimisticWrites=True)
+		self.results = []
+
+	def write(self, value):
+		self.m.set_value_async(self.vebus, '/Mode', value,
+			reply_handler=lambda r: self.results.append(('reply', r)),
+			error_handler=lambda e: self.results.append(('error', type(e))))
+
+	def test_write(self):
+		self.write(4)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 4)
+		self.assertEqual(len(self.bus.calls), 1)
+
+		# What the service reports during the write is applied afterwards
+		self.bus.emit_value(self.vebus, '/Mode', 5)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 4)
+		self.bus.reply(0)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 5)
+		self.assertEqual(self.results, [('reply', 0)])
+
+	def test_queued_writes(self):
+		self.write(4)
+		self.write(5)
+		self.write(6)
+		self.assertEqual(len(self.bus.calls), 1)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 6)
+		self.bus.reply(0)
+		self.assertEqual(unwrap_dbus_value(self.bus.calls[0][3][0]), 6)
+		self.bus.reply(0)
+		self.assertEqual(self.results, [('reply', 0)] * 3)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 6)
+
+	def test_failed_write_rolls_back(self):
+		self.write(4)
+		self.bus.fail()
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 3)
+		self.assertEqual(self.results, [('error', dbus.exceptions.DBusException)])
+
+	def test_unknown_path(self):
+		self.m.set_value_async(self.vebus, '/Missing', 1,
+			error_handler=lambda e: self.results.append(('error', type(e))))
+		self.assertEqual(self.results, [('error', TypeError)])
+		self.assertEqual(self.bus.calls, [])
+
+	def test_rejected_write_rolls_back(self):
+		self.write(4)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 4)
+		self.bus.reply(1)
+		self.assertEqual(self.m.get_value(self.vebus, '/Mode'), 3)
+		self.assertEqual(self.results, [('error', ValueError)])
+
+class RestartGraceTests(MonitorTestCase):
+	def restart(self, items):
+		old = self.bus.services[self.battery][0]
+		new = self.bus.add_service(self.battery, items)
+		self.bus.emit_owner_changed(self.battery, old, '')
+		self.scheduler.run(0.5)
+		self.bus.emit_owner_changed(self.battery, '', new)
+		self.scheduler.run(0.5)
+
+	def test_restart_passes_on_changes(self):
+		m = self.monitor(restartGraceTime=1000)
+		self.restart({'/DeviceInstance': 512, '/Soc': 51, '/Dc/0/Voltage': 12.5})
+		self.assertEqual(self.changes, [])
+		self.scheduler.run(1)
+		self.assertEqual(self.changes, [(self.battery, '/Soc', 51)])
+		self.assertEqual(self.removed, [])
+		self.assertEqual(self.added, [])
+
+		self.bus.emit_value(self.battery, '/Soc', 52)
+		self.scheduler.run()
+		self.assertEqual(m.get_value(self.battery, '/Soc'), 52)
+
+	def test_restart_gone(self):
+		m = self.monitor(restartGraceTime=1000)
+		owner = self.bus.remove_service(self.battery)
+		self.bus.emit_owner_changed(self.battery, owner, '')
+		self.scheduler.run(0.5)
+		self.assertEqual(m.get_value(self.battery, '/Soc'), 50)
+		self.scheduler.run(1)
+		self.assertEqual(m.get_value(self.battery, '/Soc'), None)
+		self.assertEqual(self.removed, [(self.battery, 512)])
+
+	def test_restart_other_device_instance(self):
+		m = self.monitor(restartGraceTime=1000)
+		self.restart({'/DeviceInstance': 513, '/Soc': 51})
+		self.scheduler.run(1)
+		self.assertEqual(self.removed, [(self.battery, 512)])
+		self.assertEqual(self.added, [(self.battery, 513)])
+		self.assertEqual(m.get_value(self.battery, '/Soc'), 51)
+
+	def test_missing_paths_not_seen(self):
+		del self.bus.services[self.battery][1]['/Dc/0/Voltage']
+		m = self.monitor(restartGraceTime=1000)
+		self.restart({'/DeviceInstance': 512})
+		self.scheduler.run(1)
+		self.assertEqual(m.get_value(self.battery, '/Soc'), None)
+		self.assertIn((self.battery, '/Soc', None), self.changes)
+		self.assertFalse(m.seen(self.battery, '/Dc/0/Voltage'))
+		self.assertNotIn(self.battery, m.get_services_with_path('/Dc/0/Voltage'))
+
+class TimerWheelTests(unittest.TestCase):
+	def setUp(self):
+		self.scheduler = StubScheduler()
+		patcher = mock.patch.object(dbusmonitor, 'time',
+			types.SimpleNamespace(monotonic=lambda: self.scheduler.now))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.fired = []
+		self.wheel = TimerWheel(self.scheduler, self.fired.append, tick=1000, size=4)
+
+	def test_deadlines(self):
+		now = self.scheduler.now
+		self.wheel.add('b', now + 2.5)
+		self.wheel.add('a', now + 1)
+		self.wheel.add('c', now + 10)
+		self.scheduler.run(1)
+		self.assertEqual(self.fired, ['a'])
+		self.scheduler.run(2)
+		self.assertEqual(self.fired, ['a', 'b'])
+		self.scheduler.run(6)
+		self.assertEqual(self.fired, ['a', 'b'])
+		self.scheduler.run(1)
+		self.assertEqual(self.fired, ['a', 'b', 'c'])
+
+		# No timer while the wheel is empty
+		self.assertEqual(self.wheel.timer, None)
+		self.assertEqual(self.scheduler.pending, [])
+
+	def test_past_deadline(self):
+		self.wheel.add('a', self.scheduler.now - 5)
+		self.scheduler.run(1)
+		self.assertEqual(self.fired, ['a'])
+
+class AlarmTests(MonitorTestCase):
+	def setUp(self):
+		super(AlarmTests, self).setUp()
+		self.m = self.monitor()
+		self.alarms = []
+
+	def alarm(self, **kwargs):
+		return self.m.add_alarm('com.victronenergy.battery', '/Soc',
+			lambda serviceName, path, active: self.alarms.append((serviceName, active)), **kwargs)
+
+	def emit(self, value):
+		self.bus.emit_value(self.battery, '/Soc', value)
+
+	def test_delay_and_hysteresis(self):
+		rule = self.alarm(below=20, hysteresis=5, delay=10)
+		self.emit(15)
+		self.scheduler.run(9)
+		self.assertEqual(self.alarms, [])
+		self.scheduler.run(1)
+		self.assertEqual(self.alarms, [(self.battery, True)])
+		self.assertEqual(self.m.get_alarms(rule), {self.battery})
+
+		self.emit(22)
+		self.emit(None)
+		self.assertEqual(len(self.alarms), 1)
+		self.emit(25)
+		self.assertEqual(self.alarms[-1], (self.battery, False))
+		self.assertEqual(self.m.get_alarms(rule), frozenset())
+
+	def test_delay_cancelled(self):
+		self.alarm(below=20, delay=10)
+		self.emit(15)
+		self.scheduler.run(5)
+		self.emit(30)
+		self.scheduler.run(10)
+		self.assertEqual(self.alarms, [])
+
+	def test_existing_value(self):
+		rule = self.alarm(above=40)
+		self.assertEqual(self.alarms, [(self.battery, True)])
+
+		owner = self.bus.remove_service(self.battery)
+		self.bus.emit_owner_changed(self.battery, owner, '')
+		self.scheduler.run()
+		self.assertEqual(self.alarms[-1], (self.battery, False))
+		self.assertEqual(self.m.get_alarms(rule), frozenset())
+
+	def test_remove_alarm(self):
+		rule = self.alarm(below=20, delay=10)
+		self.emit(15)
+		self.m.remove_alarm(rule)
+		self.scheduler.run(20)
+		self.assertEqual(self.alarms, [])
+
+	def test_path_no_longer_monitored(self):
+		rule = self.alarm(below=20, delay=10)
+		self.emit(15)
+		self.m.remove_monitored_paths('com.victronenergy.battery', ['/Soc'])
+		self.scheduler.run(20)
+		self.assertEqual(self.alarms, [])
+		self.assertEqual(self.m.get_alarms(rule), frozenset())
+
+		rule = self.alarm(above=40)
+		self.assertEqual(self.m.get_alarms(rule), frozenset())
+
+	def test_raised_path_no_longer_monitored(self):
+		rule = self.alarm(above=40)
+		self.m.remove_monitored_paths('com.victronenergy.battery', ['/Soc'])
+		self.assertEqual(self.alarms, [(self.battery, True), (self.battery, False)])
+		self.assertEqual(self.m.get_alarms(rule), frozenset())
+
+	def test_limits(self):
+		self.assertRaises(ValueError, self.alarm)
+		self.assertRaises(ValueError, self.alarm, above=1, below=0)
+
+class HistoryTests(MonitorTestCase):
+	tree = {
+		'com.victronenergy.battery': {
+			'/DeviceInstance': {},
+			'/Soc': {'history': 3},
+			'/Dc/0/Voltage': {},
+		},
+	}
+
+	def test_history(self):
+		m = self.monitor()
+		start = self.scheduler.now
+		for value in (51, None, 53):
+			self.scheduler.run(1)
+			self.bus.emit_value(self.battery, '/Soc', value)
+
+		timestamps, values = m.get_history(self.battery, '/Soc')
+		self.assertEqual(list(timestamps), [start + 1, start + 2, start + 3])
+		self.assertEqual(values[0], 51)
+		self.assertTrue(math.isnan(values[1]))
+		self.assertEqual(values[2], 53)
+
+		timestamps, values = m.get_history(self.battery, '/Soc', start=start + 2, end=start + 2)
+		self.assertEqual(list(timestamps), [start + 2])
+		self.assertEqual(m.get_history(self.battery, '/Dc/0/Voltage'), None)
+		self.assertEqual(m.get_history(self.battery, '/Missing'), None)
+
+	def test_ring(self):
+		history = History(3)
+		for i in range(5):
+			history.append(i, i * 10)
+		history.append(5, 'text')
+		timestamps, values = history.get()
+		self.assertEqual(list(timestamps), [2, 3, 4])
+		self.assertEqual(list(values), [20, 30, 40])
+		self.assertEqual(list(history.get(start=3)[1]), [30, 40])
+
+class StaleWatchTests(MonitorTestCase):
+	def setUp(self):
+		super(StaleWatchTests, self).setUp()
+		self.m = self.monitor()
+		self.stale = []
+
+	def watch(self, path='/Soc', timeout=10):
+		return self.m.add_stale_watch(self.battery, path, timeout,
+			lambda serviceName, path, stale: self.stale.append((path, stale)))
+
+	def test_stale(self):
+		self.watch()
+		self.scheduler.run(5)
+		self.bus.emit_value(self.battery, '/Soc', 51)
+		self.scheduler.run(9)
+		self.assertEqual(self.stale, [])
+		self.assertEqual(self.m.get_age(self.battery, '/Soc'), 9)
+		self.scheduler.run(2)
+		self.assertEqual(self.stale, [('/Soc', True)])
+		self.bus.emit_value(self.battery, '/Soc', 52)
+		self.assertEqual(self.stale, [('/Soc', True), ('/Soc', False)])
+		self.scheduler.run(11)
+		self.assertEqual(self.stale[-1], ('/Soc', True))
+
+	def test_remove_watch(self):
+		watch = self.watch()
+		self.m.remove_stale_watch(watch)
+		self.scheduler.run(20)
+		self.assertEqual(self.stale, [])
+
+	def test_unknown_path(self):
+		self.assertRaises(KeyError, self.watch, '/Missing')
+
+	def test_service_removed(self):
+		self.watch()
+		owner = self.bus.remove_service(self.battery)
+		self.bus.emit_owner_changed(self.battery, owner, '')
+		self.scheduler.run(20)
+		self.assertEqual(self.stale, [])
+
+	def test_path_removed(self):
+		self.watch('/Dc/0/Voltage')
+		self.m.remove_monitored_paths('com.victronenergy.battery', ['/Dc/0/Voltage'])
+		self.scheduler.run(20)
+		self.assertEqual(self.stale, [])
+
+class IntervalStatsTests(MonitorTestCase):
+	tree = {
+		'com.victronenergy.battery': {
+			'/DeviceInstance': {},
+			'/Soc': {'whenToLog': 'onIntervalAlways'},
+			'/Dc/0/Voltage': {},
+			'/Pv/*/V': {'whenToLog': 'onIntervalAlways'},
+		},
+	}
+
+	def setUp(self):
+		super(IntervalStatsTests, self).setUp()
+		self.m = self.monitor()
+		self.records = []
+		self.group = self.m.add_interval_stats(60, self.records.append)
+
+	def test_interval(self):
+		self.scheduler.run(30)
+		self.bus.emit_value(self.battery, '/Soc', 60)
+		self.scheduler.run(30)
+		self.assertEqual(self.records, [{(self.battery, '/Soc'): IntervalSummary(50, 60, 55.0, 60, 1)}])
+
+		self.scheduler.run(60)
+		self.assertEqual(self.records[1], {(self.battery, '/Soc'): IntervalSummary(60, 60, 60.0, 60, 0)})
+
+		self.m.remove_interval_stats(self.group)
+		self.scheduler.run(60)
+		self.assertEqual(len(self.records), 2)
+
+	def test_pattern_paths(self):
+		self.scheduler.run(30)
+		self.bus.emit_value(self.battery, '/Pv/1/V', 20)
+		self.scheduler.run(30)
+		self.assertEqual(self.records[0][(self.battery, '/Pv/1/V')], IntervalSummary(20, 20, 20.0, 20, 1))
+
+		self.m.remove_monitored_paths('com.victronenergy.battery', ['/Pv/*/V'])
+		self.assertNotIn((self.battery, '/Pv/1/V'), self.group.stats)
+		self.scheduler.run(60)
+		self.assertEqual(list(self.records[1]), [(self.battery, '/Soc')])
+
+	def test_service_removed(self):
+		owner = self.bus.remove_service(self.battery)
+		self.bus.emit_owner_changed(self.battery, owner, '')
+		self.scheduler.run(60)
+		self.assertEqual(self.records, [{}])
+
+class SnapshotTests(MonitorTestCase):
+	def setUp(self):
+		super(SnapshotTests, self).setUp()
+		self.m = self.monitor()
+		self.items = [(self.battery, '/Soc'), (self.vebus, '/Mode'), (self.battery, '/Missing')]
+
+	def test_read(self):
+		snapshots = self.m.snapshot_set(self.items)
+		snapshot = snapshots.read()
+		self.assertEqual(snapshot.values, {(self.battery, '/Soc'): 50,
+			(self.vebus, '/Mode'): 3, (self.battery, '/Missing'): None})
+		self.assertFalse(snapshots.changed_since(snapshot.version))
+
+		self.bus.emit_value(self.battery, '/Dc/0/Voltage', 13)
+		self.assertFalse(snapshots.changed_since(snapshot.version))
+		self.bus.emit_value(self.vebus, '/Mode', 4)
+		self.assertTrue(snapshots.changed_since(snapshot.version))
+		self.assertEqual(self.m.get_snapshot(self.items).values[(self.vebus, '/Mode')], 4)
+
+	def test_batch(self):
+		version = self.m.version
+		self.bus.emit_items(self.battery, {'/Soc': 51, '/Dc/0/Voltage': 13})
+		self.assertEqual(self.m.version, version + 1)
+
+	def test_service_removed(self):
+		snapshots = self.m.snapshot_set(self.items)
+		snapshot = snapshots.read()
+		owner = self.bus.remove_service(self.vebus)
+		self.bus.emit_owner_changed(self.vebus, owner, '')
+		self.scheduler.run()
+		self.assertTrue(snapshots.changed_since(snapshot.version))
+		self.assertEqual(snapshots.read().values[(self.vebus, '/Mode')], None)
+
+class StateTests(MonitorTestCase):
+	def setUp(self):
+		super(StateTests, self).setUp()
+		self.m = self.monitor()
+
+	def test_publish(self):
+		state = self.m.publish_state()
+		self.assertEqual(state.get_value(self.battery, '/Soc'), 50)
+		self.assertEqual(state.get_value(self.battery, '/Missing', 'x'), 'x')
+		self.assertEqual(dict(state.get_service_list('com.victronenergy.vebus')), {self.vebus: 276})
+
+		self.bus.emit_value(self.battery, '/Soc', 51)
+		self.assertIs(self.m.state, state)
+		self.scheduler.run()
+		self.assertEqual(self.m.state.get_value(self.battery, '/Soc'), 51)
+		self.assertEqual(state.get_value(self.battery, '/Soc'), 50)
+		# Services that did not change are shared
+		self.assertIs(self.m.state.services[self.vebus], state.services[self.vebus])
+
+		owner = self.bus.remove_service(self.vebus)
+		self.bus.emit_owner_changed(self.vebus, owner, '')
+		self.scheduler.run()
+		self.assertEqual(dict(self.m.state.get_service_list()), {self.battery: 512})
+
+	def test_set_value_threadsafe(self):
+		futures = []
+		thread = threading.Thread(target=lambda: futures.extend((
+			self.m.set_value_threadsafe(self.vebus, '/Mode', 4),
+			self.m.set_value_threadsafe(self.vebus, '/Missing', 4))))
+		thread.start()
+		thread.join()
+		self.scheduler.run()
+		self.bus.reply(0)
+		self.assertEqual(futures[0].result(0), 0)
+		self.assertRaises(TypeError, futures[1].result, 0)
+
+class StubExecutor(object):
+	""" Runs submitted work when the test says so. """
+	def __init__(self):
+		self.work = []
+
+	def submit(self, function, *args):
+		future = Future()
+		self.work.append((future, function, args))
+		return future
+
+	def run(self):
+		future, function, args = self.work.pop(0)
+		future.set_running_or_notify_cancel()
+		future.set_result(function(*args))
+
+class ExecutorDispatcherTests(unittest.TestCase):
+	def setUp(self):
+		self.scheduler = StubScheduler()
+		self.executor = StubExecutor()
+		self.calls = []
+		self.dispatcher = ExecutorDispatcher(self.executor, self.callback,
+			scheduler=self.scheduler, maxBatches=1, batchSize=2)
+
+	def callback(self, serviceName, path, options, changes, deviceInstance):
+		if changes['Value'] is None:
+			raise ValueError('invalid')
+		self.calls.append((path, changes['Value']))
+
+	def change(self, path, value):
+		self.dispatcher('com.victronenergy.battery.ttyO1', path, None, {'Value': value}, 512)
+
+	def test_batches(self):
+		for path, value in (('/A', 1), ('/B', 2), ('/C', 3), ('/A', 4), ('/C', 5)):
+			self.change(path, value)
+		self.scheduler.run()
+		self.assertEqual(len(self.executor.work), 1)
+		self.executor.run()
+		self.assertEqual(self.calls, [('/A', 4), ('/B', 2)])
+		self.scheduler.run()
+		self.executor.run()
+		self.scheduler.run()
+		self.assertEqual(self.calls[2:], [('/C', 5)])
+		self.assertEqual(self.dispatcher.stats, {'inflight': 0, 'pending': 0, 'maxpending': 3,
+			'submitted': 3, 'completed': 3, 'failed': 0, 'coalesced': 2})
+
+	def test_in_order_per_path(self):
+		self.change('/A', 1)
+		self.scheduler.run()
+		self.change('/A', 2)
+		self.change('/A', 3)
+		self.scheduler.run()
+		self.executor.run()
+		self.scheduler.run()
+		self.executor.run()
+		self.assertEqual(self.calls, [('/A', 1), ('/A', 3)])
+		self.assertEqual(self.dispatcher.stats['coalesced'], 1)
+
+	def test_errors(self):
+		self.change('/A', None)
+		self.change('/B', 1)
+		self.scheduler.run()
+		with self.assertLogs('dbusmonitor', 'ERROR'):
+			self.executor.run()
+		self.scheduler.run()
+		self.assertEqual(self.calls, [('/B', 1)])
+		self.assertEqual(self.dispatcher.stats['failed'], 1)
+		self.assertEqual(self.dispatcher.stats['completed'], 1)
+
+class AsyncioMonitorTests(MonitorTestCase):
+	def setUp(self):
+		super(AsyncioMonitorTests, self).setUp()
+		self.loop = asyncio.new_event_loop()
+		self.addCleanup(self.loop.close)
+		self.m = AsyncioDbusMonitor(self.tree, deviceAddedCallback=self.device_added,
+			scheduler=self.scheduler, loop=self.loop)
+		self.bus.answer()
+		self.scheduler.run()
+
+	def scan(self, services=None):
+		task = self.loop.create_task(self.m.scan(services))
+		self.loop.run_until_complete(asyncio.sleep(0))
+		self.bus.answer()
+		self.scheduler.run()
+		return self.loop.run_until_complete(task)
+
+	def test_scan_complete(self):
+		self.assertTrue(self.m.scan_complete.done())
+		self.assertEqual(sorted(self.added), [(self.battery, 512), (self.vebus, 276)])
+
+	def test_rescan_skips_known_services(self):
+		other = 'com.victronenergy.battery.ttyO3'
+		self.bus.add_service(other, {'/DeviceInstance': 513, '/Soc': 80})
+		del self.added[:]
+		self.assertEqual(self.scan(), [])
+		self.assertEqual(self.added, [(other, 513)])
+		self.assertEqual(self.m.get_service_list('com.victronenergy.battery'),
+			{self.battery: 512, other: 513})
+		self.assertEqual(len(self.m.servicesByClass['com.victronenergy.battery']), 2)
+
+		self.assertEqual(self.scan([self.battery]), [])
+		self.assertEqual(self.added, [(other, 513)])
+
+	def test_changes(self):
+		async def consume():
+			result = []
+			async with self.m.changes('com.victronenergy.battery') as changes:
+				self.bus.emit_value(self.battery, '/Soc', 51)
+				self.bus.emit_value(self.vebus, '/Mode', 4)
+				self.bus.emit_value(self.battery, '/Dc/0/Voltage', 12.6)
+				self.bus.emit_value(self.battery, '/Soc', 52)
+				self.scheduler.run()
+				async for change in changes:
+					result.append((change.path, change.changes['Value']))
+					if len(result) == 2:
+						break
+			return result
+
+		# Changes are coalesced per path
+		self.assertEqual(self.loop.run_until_complete(consume()),
+			[('/Soc', 52), ('/Dc/0/Voltage', 12.6)])
+		self.assertEqual(len(self.m._streams), 0)
+		self.assertIsNone(self.m.valueChangedCallback)
+
+	def test_changes_left_behind(self):
+		async def consume():
+			async for change in self.m.changes():
+				return change.path
+
+		task = self.loop.create_task(consume())
+		self.loop.run_until_complete(asyncio.sleep(0))
+		self.bus.emit_value(self.vebus, '/Mode', 4)
+		self.scheduler.run()
+		self.assertEqual(self.loop.run_until_complete(task), '/Mode')
+		self.assertEqual(len(self.m._streams), 0)
+
+		self.bus.emit_value(self.vebus, '/Mode', 5)
+		self.scheduler.run()
+		self.assertIsNone(self.m.valueChangedCallback)
+
+if __name__ == "__main__":
+	unittest.main()
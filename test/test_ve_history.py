@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Python
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Local
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+from ve_history import HistoryStore
+
+class Summary(object):
+	def __init__(self, min, max, mean, last, count):
+		self.min = min
+		self.max = max
+		self.mean = mean
+		self.last = last
+		self.count = count
+
+class HistoryStoreTests(unittest.TestCase):
+	service = 'com.victronenergy.battery.ttyO1'
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'history.dat')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def open(self, **kwargs):
+		kwargs.setdefault('segmentSize', 4096)
+		kwargs.setdefault('segments', 8)
+		kwargs.setdefault('rollupSegments', 2)
+		return HistoryStore(self.filename, **kwargs)
+
+	def test_values(self):
+		store = self.open()
+		values = [12, 13, -5, 10 ** 12, 12.5, 12.345, math.pi, None, True, 3.0]
+		for i, v in enumerate(values):
+			store.add(self.service, '/Dc/0/Voltage', v, timestamp=1000 + i)
+		store.add(self.service, '/Serial', 'HQ1234', timestamp=1000)
+
+		result = store.query(self.service, '/Dc/0/Voltage')
+		self.assertEqual([t for t, v in result], [1000 + i for i in range(len(values))])
+		self.assertEqual([v for t, v in result], values)
+		self.assertEqual(store.query(self.service, '/Serial'), [])
+		store.close()
+
+	def test_range(self):
+		store = self.open()
+		for i in range(100):
+			store.add(self.service, '/Soc', i, timestamp=1000 + i)
+		self.assertEqual(store.query(self.service, '/Soc', start=1010, end=1012),
+			[(1010, 10), (1011, 11), (1012, 12)])
+		store.close()
+
+	def test_clock_set_back(self):
+		store = self.open()
+		store.add(self.service, '/Soc', 50, timestamp=5000)
+		store.add(self.service, '/Soc', 51, timestamp=4000)
+		store.add(self.service, '/Soc', 52, timestamp=4001)
+		self.assertEqual(store.query(self.service, '/Soc', start=4500), [(5000, 50)])
+		self.assertEqual(store.query(self.service, '/Soc', end=4000), [(4000, 51)])
+		store.close()
+
+		store = self.open()
+		self.assertEqual(store.query(self.service, '/Soc', start=4500), [(5000, 50)])
+		self.assertEqual(store.query(self.service, '/Soc', end=4000), [(4000, 51)])
+		store.close()
+
+	def test_reopen(self):
+		store = self.open()
+		for i in range(1000):
+			store.add(self.service, '/Soc', i, timestamp=1000 + i)
+		store.close()
+
+		store = self.open()
+		store.add(self.service, '/Soc', 1000, timestamp=2000)
+		result = store.query(self.service, '/Soc')
+		self.assertEqual([v for t, v in result], list(range(1001)))
+		store.close()
+
+	def test_layout_changed(self):
+		store = self.open()
+		store.add(self.service, '/Soc', 1, timestamp=1000)
+		store.close()
+
+		store = self.open(segments=4)
+		self.assertEqual(store.query(self.service, '/Soc'), [])
+		store.close()
+
+	def test_ring_overwrites_oldest(self):
+		# Like a busy system: many paths, changing often
+		store = self.open()
+		paths = ['/Ac/L%d/P' % i for i in range(50)]
+		for n in range(4000):
+			for path in paths:
+				store.add(self.service, path, n * 0.5, timestamp=1000 + n * 0.01)
+
+		result = store.query(self.service, paths[0])
+		values = [v for t, v in result]
+		self.assertEqual(values[-1], 3999 * 0.5)
+		self.assertEqual(values, [n * 0.5 for n in range(4000 - len(values), 4000)])
+		self.assertLess(len(values), 4000)
+		store.close()
+
+	def test_rollups(self):
+		store = self.open()
+		store.add_rollups({(self.service, '/Soc'): Summary(10, 20, 15.5, 12, 3),
+			(self.service, '/Serial'): Summary(None, None, None, 'HQ', 1)}, timestamp=1060)
+		self.assertEqual(store.query_rollups(self.service, '/Soc'), [(1060, 3, 10, 20, 15.5)])
+		self.assertEqual(store.query_rollups(self.service, '/Serial'), [])
+		store.close()
+
+	def test_export(self):
+		store = self.open()
+		store.add(self.service, '/Soc', 50, timestamp=1000)
+		store.add('com.victronenergy.vebus.ttyO2', '/Mode', 3, timestamp=1001)
+		store.add(self.service, '/Soc', 51, timestamp=1002)
+		self.assertEqual(list(store.export(start=1001)), [
+			(1001, 'com.victronenergy.vebus.ttyO2', '/Mode', 3),
+			(1002, self.service, '/Soc', 51)])
+		store.close()
+
+if __name__ == "__main__":
+	unittest.main()
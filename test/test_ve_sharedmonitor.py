@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Local
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+from ve_sharedmonitor import SharedMonitorPublisher, SharedMonitorReader, HEADER, SEQ
+
+class Value(object):
+	def __init__(self, value):
+		self.value = value
+
+class Service(object):
+	def __init__(self, name, deviceInstance, paths):
+		self.name = name
+		self.deviceInstance = deviceInstance
+		self.paths = {path: Value(v) for path, v in paths.items()}
+
+class SharedMonitorTests(unittest.TestCase):
+	battery = 'com.victronenergy.battery.ttyO1'
+	vebus = 'com.victronenergy.vebus.ttyO2'
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'dbusmonitor')
+		self.publisher = SharedMonitorPublisher(self.filename, slots=16, slotSize=96)
+		self.service = Service(self.battery, 512, {'/Soc': 50, '/Dc/0/Voltage': 12.5,
+			'/CustomName': 'House', '/Alarms/Low': None})
+		self.publisher.service_added(self.service)
+		self.reader = SharedMonitorReader(self.filename)
+
+	def tearDown(self):
+		self.reader.close()
+		shutil.rmtree(self.dir)
+
+	def test_get_value(self):
+		self.assertEqual(self.reader.get_value(self.battery, '/Soc'), 50)
+		self.assertEqual(self.reader.get_value(self.battery, '/Dc/0/Voltage'), 12.5)
+		self.assertEqual(self.reader.get_value(self.battery, '/CustomName'), 'House')
+		self.assertEqual(self.reader.get_value(self.battery, '/Alarms/Low', 'x'), 'x')
+		self.assertEqual(self.reader.get_value(self.battery, '/Missing', 'x'), 'x')
+		self.assertTrue(self.reader.seen(self.battery, '/Alarms/Low'))
+
+		self.publisher.value_changed(self.service, '/Soc', 51)
+		self.assertEqual(self.reader.get_value(self.battery, '/Soc'), 51)
+
+	def test_too_large(self):
+		self.publisher.value_changed(self.service, '/CustomName', 'x' * 200)
+		self.assertEqual(self.reader.get_value(self.battery, '/CustomName'), None)
+
+	def test_key_too_large(self):
+		path = '/' + 'x' * 100
+		vebus = Service(self.vebus, 276, {'/Mode': 3, path: 1})
+		self.publisher.service_added(vebus)
+		self.publisher.value_changed(vebus, path, 2)
+		self.assertEqual(self.reader.get_value(self.vebus, '/Mode'), 3)
+		self.assertFalse(self.reader.seen(self.vebus, path))
+		self.assertEqual(self.reader.get_service_list(), {self.battery: 512, self.vebus: 276})
+
+	def test_publisher_died_mid_write(self):
+		slot = self.publisher.index[(self.battery, '/Soc')]
+		offset = HEADER.size + slot * self.publisher.slotSize
+		SEQ.pack_into(self.publisher.mm, offset, self.publisher.seqs[slot] + 1)
+		self.publisher._bump_generation()
+		self.assertEqual(self.reader.get_value(self.battery, '/Soc', 'x'), 'x')
+		self.assertEqual(self.reader.get_value(self.battery, '/Dc/0/Voltage'), 12.5)
+
+	def test_services(self):
+		vebus = Service(self.vebus, 276, {'/Mode': 3})
+		self.publisher.service_added(vebus)
+		self.assertEqual(self.reader.get_service_list(), {self.battery: 512, self.vebus: 276})
+		self.assertEqual(self.reader.get_service_list('com.victronenergy.vebus'), {self.vebus: 276})
+		self.assertEqual(self.reader.get_device_instance(self.vebus), 276)
+
+		self.publisher.service_removed(self.service)
+		self.assertEqual(self.reader.get_service_list(), {self.vebus: 276})
+		self.assertEqual(self.reader.get_value(self.battery, '/Soc'), None)
+
+		# Slots are reused
+		for i in range(5):
+			self.publisher.service_added(Service('com.victronenergy.tank.%d' % i, i, {'/Level': i}))
+		self.assertEqual(self.reader.get_value('com.victronenergy.tank.4', '/Level'), 4)
+
+	def test_poll(self):
+		self.assertEqual(len(self.reader.poll()), 4)
+		self.assertEqual(self.reader.poll(), [])
+		self.publisher.value_changed(self.service, '/Soc', 51)
+		self.publisher.value_changed(self.service, '/Soc', 52)
+		self.assertEqual(self.reader.poll(), [(self.battery, '/Soc', 52, 512)])
+
+	def test_publisher_restart(self):
+		self.publisher = SharedMonitorPublisher(self.filename, slots=16, slotSize=96)
+		self.assertEqual(self.reader.get_service_list(), {})
+		self.publisher.service_added(Service(self.vebus, 276, {'/Mode': 3}))
+		self.assertEqual(self.reader.get_value(self.vebus, '/Mode'), 3)
+
+		# With another layout, readers move over to the new file
+		self.publisher = SharedMonitorPublisher(self.filename, slots=32, slotSize=96)
+		self.publisher.service_added(Service(self.vebus, 276, {'/Mode': 4}))
+		self.assertEqual(self.reader.get_value(self.vebus, '/Mode'), 4)
+
+	def test_publisher_stopped(self):
+		self.publisher.close()
+		self.assertEqual(self.reader.get_service_list(), {})
+		self.assertEqual(self.reader.get_value(self.battery, '/Soc', 'x'), 'x')
+		self.assertFalse(self.reader.seen(self.battery, '/Soc'))
+		self.assertEqual(self.reader.poll(), [])
+
+		self.publisher = SharedMonitorPublisher(self.filename, slots=16, slotSize=96)
+		self.publisher.service_added(Service(self.vebus, 276, {'/Mode': 3}))
+		self.assertEqual(self.reader.get_service_list(), {self.vebus: 276})
+		self.assertEqual(self.reader.get_value(self.vebus, '/Mode'), 3)
+		self.assertEqual(self.reader.poll(), [(self.vebus, '/Mode', 3, 276)])
+
+	def test_reader_first(self):
+		filename = os.path.join(self.dir, 'other')
+		reader = SharedMonitorReader(filename)
+		self.assertEqual(reader.get_service_list(), {})
+		self.assertEqual(reader.get_value(self.battery, '/Soc', 'x'), 'x')
+
+		publisher = SharedMonitorPublisher(filename, slots=16, slotSize=96)
+		publisher.service_added(self.service)
+		self.assertEqual(reader.get_value(self.battery, '/Soc'), 50)
+		reader.close()
+		publisher.close()
+
+if __name__ == "__main__":
+	unittest.main()
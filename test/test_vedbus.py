@@ -118,12 +118,26 @@ class VeDbusItemExportTests(unittest.TestCase):
 	def test_gettextcallback(self):
 		self.assertEqual('gettexted /Gettextcallback 10', self.dbusConn.get_object('com.victronenergy.dbusexample', '/Gettextcallback').GetText())
 
+	def test_textformat(self):
+		self.assertEqual('12.3V', self.dbusConn.get_object('com.victronenergy.dbusexample', '/Textformat').GetText())
+		o = self.dbusConn.get_object('com.victronenergy.dbusexample', '/TextformatBraces')
+		self.assertEqual('1.50 A', o.GetText())
+		self.assertEqual(0, o.SetValue(2.25))
+		self.assertEqual('2.25 A', o.GetText())
+		self.assertEqual(0, o.SetValue('not a number'))
+		self.assertEqual('not a number', o.GetText())
+
+	def test_notext_gettext(self):
+		self.assertEqual('2.5', self.dbusConn.get_object('com.victronenergy.dbusexample', '/NoText').GetText())
+		self.assertEqual('gettexted /NoTextGettextcallback 10',
+			self.dbusConn.get_object('com.victronenergy.dbusexample', '/NoTextGettextcallback').GetText())
+
 	def waitandkill(self, seconds=5):
 		time.sleep(seconds)
 		self.process.kill()
 		self.process.wait()
 
-	def test_changedsignal(self):
+	def monitor_signals(self, path, value):
 		self.process = subprocess.Popen(['dbus-monitor', "type='signal',sender='com.victronenergy.dbusexample',interface='com.victronenergy.BusItem'"], stdout=subprocess.PIPE)
 
 		#wait for dbus-monitor to start up
@@ -133,7 +147,7 @@ class VeDbusItemExportTests(unittest.TestCase):
 		thread = threading.Thread(target=self.waitandkill)
 		thread.start()
 
-		self.dbusConn.get_object('com.victronenergy.dbusexample', '/Gettextcallback').SetValue(60)
+		self.dbusConn.get_object('com.victronenergy.dbusexample', path).SetValue(value)
 
 		fcntl.fcntl(self.process.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
 
@@ -146,6 +160,11 @@ class VeDbusItemExportTests(unittest.TestCase):
 			except IOError:
 				break
 		self.process.stdout.close()
+		thread.join()
+		return t
+
+	def test_changedsignal(self):
+		t = self.monitor_signals('/Gettextcallback', 60)
 
 		text = b"      dict entry(\n"
 		text += b"         string \"Text\"\n"
@@ -160,7 +179,21 @@ class VeDbusItemExportTests(unittest.TestCase):
 		self.assertNotEqual(-1, t.find(text))
 		self.assertNotEqual(-1, t.find(value))
 
-		thread.join()
+	def test_changedsignal_notext(self):
+		t = self.monitor_signals('/NoText', 3.5)
+
+		value = b"      dict entry(\n"
+		value += b"         string \"Value\"\n"
+		value += b"         variant             double 3.5\n"
+		value += b"      )\n"
+
+		self.assertNotEqual(-1, t.find(value))
+		self.assertEqual(-1, t.find(b"string \"Text\""))
+
+	def test_changedsignal_notext_gettextcallback(self):
+		# Text that differs from the value is always sent
+		t = self.monitor_signals('/NoTextGettextcallback', 60)
+		self.assertNotEqual(-1, t.find(b"string \"gettexted /NoTextGettextcallback 60\""))
 
 """
 MVA 2014-08-30: this test of VEDbusItemImport doesn't work, since there is no gobject-mainloop.
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## @package ve_asyncio
+# Runs DbusMonitor and VeDbusService on an asyncio event loop.
+#
+# dbus-python only dispatches through the GLib mainloop, so rather than running
+# GLib in a thread next to asyncio, asyncio itself is run on top of GLib, using
+# the event loop policy that PyGObject provides (3.50 and newer). Signals, D-Bus
+# method calls and coroutines then all run in the same thread, and VeDbusService
+# works unchanged. Call setup_event_loop() before asyncio.run():
+#
+#	setup_event_loop()
+#
+#	async def main():
+#		monitor = AsyncioDbusMonitor(tree)
+#		await monitor.scan_complete
+#		async with monitor.changes('com.victronenergy.battery') as changes:
+#			async for change in changes:
+#				print(change.serviceName, change.path, change.changes['Value'])
+#
+#	asyncio.run(main())
+
+import asyncio
+from collections import namedtuple, OrderedDict
+from functools import partial
+import weakref
+from dbus.mainloop.glib import DBusGMainLoop
+
+# our own packages
+from dbusmonitor import AsyncDbusMonitor
+from ve_utils import exit_on_error
+
+ValueChange = namedtuple('ValueChange', 'serviceName path options changes deviceInstance')
+
+def setup_event_loop():
+	""" Makes GLib the default mainloop for dbus-python, and makes asyncio
+	    create event loops that run on the GLib mainloop. """
+	try:
+		from gi.events import GLibEventLoopPolicy
+	except ImportError:
+		raise RuntimeError("Running asyncio on the GLib mainloop requires PyGObject 3.50 or newer")
+
+	DBusGMainLoop(set_as_default=True)
+	asyncio.set_event_loop_policy(GLibEventLoopPolicy())
+
+class AsyncioScheduler(object):
+	""" The asyncio counterpart of dbusmonitor.GLibScheduler. """
+	def __init__(self, loop):
+		self.loop = loop
+
+	def call_soon(self, callback, *args):
+		return self.loop.call_soon(exit_on_error, callback, *args)
+
+	def call_later(self, delay, callback, *args):
+		""" Calls callback after delay milliseconds. """
+		return self.loop.call_later(delay / 1000.0, exit_on_error, callback, *args)
+
+	def call_soon_threadsafe(self, callback, *args):
+		self.loop.call_soon_threadsafe(exit_on_error, callback, *args)
+
+	def cancel(self, handle):
+		handle.cancel()
+
+class ChangeStream(object):
+	""" Async iterator over the value changes of a monitor, see
+	    AsyncioDbusMonitor.changes. Like DispatchQueue, it holds at most one
+	    change per (service, path), so a consumer that falls behind skips
+	    the intermediate values rather than letting them pile up. """
+	def __init__(self, monitor, classfilter):
+		self.monitor = monitor
+		self.classfilter = classfilter
+		self.pending = OrderedDict()
+		self.waiter = None
+		self.closed = False
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		while not self.pending:
+			if self.closed:
+				raise StopAsyncIteration
+			self.waiter = self.monitor.loop.create_future()
+			try:
+				await self.waiter
+			finally:
+				self.waiter = None
+		return self.pending.popitem(last=False)[1]
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		self.close()
+
+	def put(self, change):
+		if self.classfilter is None or change.serviceName.startswith(self.classfilter + '.'):
+			self.pending[(change.serviceName, change.path)] = change
+			self._wake()
+
+	def _wake(self):
+		if self.waiter is not None and not self.waiter.done():
+			self.waiter.set_result(None)
+
+	def close(self):
+		""" Stops the stream, changes that are still waiting are dropped. """
+		if not self.closed:
+			self.closed = True
+			self.pending.clear()
+			self.monitor._remove_stream(self)
+			self._wake()
+
+	async def aclose(self):
+		self.close()
+
+class AsyncioDbusMonitor(AsyncDbusMonitor):
+	""" An AsyncDbusMonitor for use from coroutines. It must be created
+	    while the event loop is running, and expects that loop to run on
+	    GLib, see setup_event_loop. Await scan_complete to wait for the
+	    initial scan. """
+	def __init__(self, *args, scanCompleteCallback=None, loop=None, **kwargs):
+		self.loop = loop or asyncio.get_running_loop()
+		self.scan_complete = self.loop.create_future()
+		self._scanCompleteCallback = scanCompleteCallback
+		self._streams = weakref.WeakSet()
+		kwargs.setdefault('scheduler', AsyncioScheduler(self.loop))
+		super().__init__(*args, scanCompleteCallback=self._scan_complete_done, **kwargs)
+
+		# Only have DbusMonitor schedule value changes when someone wants them
+		self._valueChangedCallback = self.valueChangedCallback
+		self._update_value_changed_callback()
+
+	def _scan_complete_done(self, monitor):
+		if not self.scan_complete.done():
+			self.scan_complete.set_result(None)
+		if self._scanCompleteCallback is not None:
+			self._scanCompleteCallback(monitor)
+
+	def _update_value_changed_callback(self):
+		if self._streams or self._valueChangedCallback is not None:
+			self.valueChangedCallback = self._value_changed
+		else:
+			self.valueChangedCallback = None
+
+	def _value_changed(self, serviceName, objectPath, options, changes, deviceInstance):
+		if self._valueChangedCallback is not None:
+			self._valueChangedCallback(serviceName, objectPath, options, changes, deviceInstance)
+		if self._streams:
+			change = ValueChange(serviceName, objectPath, options, changes, deviceInstance)
+			for stream in list(self._streams):
+				stream.put(change)
+		else:
+			# The last stream was dropped without being closed
+			self._update_value_changed_callback()
+
+	def changes(self, classfilter=None):
+		""" Returns an async iterator that yields a ValueChange for every
+		    change that would be passed to valueChangedCallback, optionally
+		    only for services of one class. Use it as an async context
+		    manager, or call close() or aclose() on it to stop. The monitor
+		    only keeps a weak reference, so a stream that is left behind,
+		    for example by breaking out of an async for, also goes away. """
+		stream = ChangeStream(self, classfilter)
+		self._streams.add(stream)
+		self._update_value_changed_callback()
+		return stream
+
+	def _remove_stream(self, stream):
+		self._streams.discard(stream)
+		self._update_value_changed_callback()
+
+	async def scan(self, services=None):
+		""" Scans the given services, or all wanted services on the bus,
+		    and returns once that is done. Services that are already known
+		    are skipped. Returns the names of services that could not be
+		    scanned using GetItems, and were scanned the legacy way instead. """
+		services = [s for s in (self.wanted_service_names() if services is None else services) \
+			if s not in self.servicesByName]
+		if not services:
+			return []
+
+		future = self.loop.create_future()
+		self.scan_dbus_services_async(services=services,
+			callback=partial(self._scan_done, future))
+		return await future
+
+	def _scan_done(self, future, errors):
+		self._async_scan_callback(False, errors)
+		if not future.done():
+			future.set_result(errors)
+
+	async def async_set_value(self, serviceName, objectPath, value):
+		""" Coroutine version of set_value_async, returns the result of
+		    SetValue or raises the error. """
+		future = self.loop.create_future()
+		self.set_value_async(serviceName, objectPath, value,
+			reply_handler=partial(_set_future_result, future),
+			error_handler=partial(_set_future_exception, future))
+		return await future
+
+def _set_future_result(future, result):
+	if not future.done():
+		future.set_result(result)
+
+def _set_future_exception(future, exc):
+	if not future.done():
+		future.set_exception(exc)
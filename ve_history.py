@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## @package ve_history
+# Keeps the history of monitored values in a file, so that it survives
+# restarts.
+#
+# The file is a fixed size ring of segments, and a second, smaller ring of
+# segments with rollups: the minimum, maximum and mean of each path per
+# interval, which therefore reach back further. The segment being filled is
+# kept in memory and only copied to the file when it is full, and every
+# flushInterval seconds, so a change does not cost a write to flash.
+#
+# Within a segment, each record is a tag byte followed by varints: the
+# number of the path, the milliseconds since the previous record, and the
+# value as the difference from the previous value of that path. Floats that
+# are whole thousandths are stored that way too, other floats as doubles.
+# Each segment starts from scratch, so old segments can be overwritten
+# without breaking the newer ones.
+#
+#	store = HistoryStore('/data/history.dat')
+#	monitor = DbusMonitor(tree, valueChangedCallback=store.value_changed)
+#	store.attach(monitor)
+#	...
+#	for timestamp, value in store.query(serviceName, '/Dc/0/Voltage', start=time.time() - 3600):
+#		...
+
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+FILE_MAGIC = b'VEHF'
+SEGMENT_MAGIC = b'VEHS'
+VERSION = 2
+
+# magic, version, segment size, segments, rollup segments
+FILE_HEADER = struct.Struct('<4sIIII')
+FILE_HEADER_SIZE = 4096
+
+# magic, sequence number, first, lowest and highest timestamp in ms, bytes
+# used. The clock can be set back, so the first timestamp is not always the
+# lowest.
+SEGMENT_HEADER = struct.Struct('<4sIqqqI')
+
+TAG_DEFINE = 1
+TAG_INT = 2
+TAG_MILLI = 3
+TAG_DOUBLE = 4
+TAG_INVALID = 5
+TAG_ROLLUP = 6
+
+DOUBLE = struct.Struct('<d')
+ROLLUP = struct.Struct('<ddd')
+
+def _put_varint(buf, n):
+	while n > 0x7f:
+		buf.append((n & 0x7f) | 0x80)
+		n >>= 7
+	buf.append(n)
+
+def _put_signed(buf, n):
+	_put_varint(buf, n * 2 if n >= 0 else -n * 2 - 1)
+
+def _get_varint(data, pos):
+	n = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return n, pos
+		shift += 7
+
+def _get_signed(data, pos):
+	n, pos = _get_varint(data, pos)
+	return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+def _split_key(key):
+	i = key.index('/')
+	return key[:i], key[i:]
+
+class Segment(object):
+	""" The encoder state of the segment being filled. """
+	def __init__(self, seq, size):
+		super(Segment, self).__init__()
+		self.seq = seq
+		self.size = size
+		self.data = bytearray(SEGMENT_HEADER.size)
+		self.ids = {}
+		self.previous = {}
+		self.start = None
+		self.last = None
+		self.min = None
+		self.max = None
+
+	def encode(self, key, timestamp, tag, value):
+		""" Returns the record for a sample, without adding it. """
+		buf = bytearray()
+		i = self.ids.get(key)
+		if i is None:
+			i = len(self.ids)
+			name = key.encode('utf-8')
+			buf.append(TAG_DEFINE)
+			_put_varint(buf, i)
+			_put_varint(buf, len(name))
+			buf.extend(name)
+
+		buf.append(tag)
+		_put_varint(buf, i)
+		_put_signed(buf, timestamp - (timestamp if self.last is None else self.last))
+		if tag == TAG_INT or tag == TAG_MILLI:
+			_put_signed(buf, value - self.previous.get(i, 0))
+		elif tag == TAG_DOUBLE:
+			buf.extend(DOUBLE.pack(value))
+		elif tag == TAG_ROLLUP:
+			count, values = value
+			_put_varint(buf, count)
+			buf.extend(ROLLUP.pack(*values))
+		return i, buf
+
+	def fits(self, record):
+		return len(self.data) + len(record) <= self.size
+
+	def add(self, key, i, timestamp, tag, value, record):
+		self.ids[key] = i
+		if tag == TAG_INT or tag == TAG_MILLI:
+			self.previous[i] = value
+		if self.start is None:
+			self.start = self.min = self.max = timestamp
+		else:
+			self.min = min(self.min, timestamp)
+			self.max = max(self.max, timestamp)
+		self.last = timestamp
+		self.data.extend(record)
+
+	def header(self):
+		return SEGMENT_HEADER.pack(SEGMENT_MAGIC, self.seq, self.start or 0,
+			self.min or 0, self.max or 0, len(self.data))
+
+def decode_segment(data):
+	""" Yields (key, timestamp in ms, tag, value) for the records in the
+	    data of a segment, including its header. For rollups the value is
+	    (count, min, max, mean). """
+	magic, seq, start, lowest, highest, used = SEGMENT_HEADER.unpack_from(data)
+	keys = {}
+	previous = {}
+	timestamp = start
+	pos = SEGMENT_HEADER.size
+	while pos < used:
+		tag = data[pos]
+		pos += 1
+		i, pos = _get_varint(data, pos)
+		if tag == TAG_DEFINE:
+			n, pos = _get_varint(data, pos)
+			keys[i] = bytes(data[pos:pos + n]).decode('utf-8')
+			pos += n
+			continue
+
+		dt, pos = _get_signed(data, pos)
+		timestamp += dt
+		if tag == TAG_INT or tag == TAG_MILLI:
+			delta, pos = _get_signed(data, pos)
+			value = previous[i] = previous.get(i, 0) + delta
+			if tag == TAG_MILLI:
+				value = value / 1000.0
+		elif tag == TAG_DOUBLE:
+			value, = DOUBLE.unpack_from(data, pos)
+			pos += DOUBLE.size
+		elif tag == TAG_INVALID:
+			value = None
+		elif tag == TAG_ROLLUP:
+			count, pos = _get_varint(data, pos)
+			value = (count,) + ROLLUP.unpack_from(data, pos)
+			pos += ROLLUP.size
+		else:
+			logger.error("Unknown tag %d in history segment %d, skipping the rest" % (tag, seq))
+			return
+		yield keys[i], timestamp, tag, value
+
+class Ring(object):
+	""" A ring of count segments of size bytes, starting at offset in the
+	    file. The segment being filled is kept in memory. """
+	def __init__(self, mm, offset, count, size):
+		super(Ring, self).__init__()
+		self.mm = mm
+		self.offset = offset
+		self.count = count
+		self.size = size
+
+		# Continue after the newest segment in the file
+		newest = -1
+		self.index = 0
+		for index in range(count):
+			header = self._read_header(index)
+			if header is not None and header[1] > newest:
+				newest = header[1]
+				self.index = (index + 1) % count
+		self.segment = Segment(newest + 1, size)
+
+	def _read_header(self, index):
+		header = SEGMENT_HEADER.unpack_from(self.mm, self.offset + index * self.size)
+		if header[0] != SEGMENT_MAGIC or header[5] > self.size:
+			return None
+		return header
+
+	def add(self, key, timestamp, tag, value):
+		segment = self.segment
+		i, record = segment.encode(key, timestamp, tag, value)
+		if not segment.fits(record):
+			self.next_segment()
+			segment = self.segment
+			i, record = segment.encode(key, timestamp, tag, value)
+			if not segment.fits(record):
+				logger.error("Record for %s does not fit in a history segment" % key)
+				return
+		segment.add(key, i, timestamp, tag, value, record)
+
+	def write(self):
+		""" Copies the segment being filled to the file. """
+		segment = self.segment
+		if segment.start is None:
+			return
+		segment.data[:SEGMENT_HEADER.size] = segment.header()
+		offset = self.offset + self.index * self.size
+		self.mm[offset:offset + len(segment.data)] = segment.data
+
+	def next_segment(self):
+		self.write()
+		self.index = (self.index + 1) % self.count
+		self.segment = Segment(self.segment.seq + 1, self.size)
+
+	def segments(self, start=None, end=None):
+		""" Returns the data of the segments with samples between start and
+		    end, in ms, oldest first. """
+		found = []
+		for index in range(self.count):
+			if index == self.index:
+				continue
+			header = self._read_header(index)
+			if header is None or (start is not None and header[4] < start) or \
+					(end is not None and header[3] > end):
+				continue
+			offset = self.offset + index * self.size
+			found.append((header[1], self.mm[offset:offset + header[5]]))
+		found.sort()
+
+		segment = self.segment
+		if segment.start is not None and (start is None or segment.max >= start) and \
+				(end is None or segment.min <= end):
+			segment.data[:SEGMENT_HEADER.size] = segment.header()
+			found.append((segment.seq, bytes(segment.data)))
+		return [data for seq, data in found]
+
+class HistoryStore(object):
+	""" Stores value changes and rollups in a file, see the description of
+	    this module. If the file exists with another layout, it is started
+	    anew. """
+	def __init__(self, filename, segmentSize=65536, segments=64, rollupSegments=16,
+			flushInterval=300):
+		self.filename = filename
+		self.flushInterval = flushInterval
+		self._flushTimer = None
+		self._scheduler = None
+		self._monitor = None
+		self._rollupGroup = None
+
+		size = FILE_HEADER_SIZE + (segments + rollupSegments) * segmentSize
+		header = FILE_HEADER.pack(FILE_MAGIC, VERSION, segmentSize, segments, rollupSegments)
+		fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			existing = os.pread(fd, FILE_HEADER.size, 0)
+			if existing != header or os.fstat(fd).st_size != size:
+				if existing:
+					logger.warning("%s has another layout, starting a new history" % filename)
+				os.ftruncate(fd, 0)
+				os.ftruncate(fd, size)
+				os.pwrite(fd, header, 0)
+			self.mm = mmap.mmap(fd, size)
+		finally:
+			os.close(fd)
+
+		self.raw = Ring(self.mm, FILE_HEADER_SIZE, segments, segmentSize)
+		self.rollups = Ring(self.mm, FILE_HEADER_SIZE + segments * segmentSize,
+			rollupSegments, segmentSize)
+
+	def add(self, serviceName, path, value, timestamp=None):
+		""" Stores a value, at timestamp in seconds since the epoch or now.
+		    Invalid values (None) are stored as such, values that are not
+		    numbers are left out. """
+		t = int((time.time() if timestamp is None else timestamp) * 1000)
+		if value is None:
+			self.raw.add(serviceName + path, t, TAG_INVALID, None)
+		elif isinstance(value, int):
+			self.raw.add(serviceName + path, t, TAG_INT, int(value))
+		elif isinstance(value, float):
+			milli = round(value * 1000) if math.isfinite(value) else None
+			if milli is not None and milli / 1000.0 == value:
+				self.raw.add(serviceName + path, t, TAG_MILLI, milli)
+			else:
+				self.raw.add(serviceName + path, t, TAG_DOUBLE, value)
+
+	def value_changed(self, serviceName, path, options, changes, deviceInstance):
+		""" Can be used as, or called from, the valueChangedCallback of a
+		    DbusMonitor. """
+		self.add(serviceName, path, changes['Value'])
+
+	def add_rollups(self, records, timestamp=None):
+		""" Stores a dictionary of DbusMonitor IntervalSummary tuples indexed
+		    by (serviceName, path), as passed by add_interval_stats. """
+		t = int((time.time() if timestamp is None else timestamp) * 1000)
+		for (serviceName, path), summary in records.items():
+			if summary.mean is None:
+				continue
+			self.rollups.add(serviceName + path, t, TAG_ROLLUP, (summary.count,
+				(summary.min, summary.max, summary.mean)))
+
+	def attach(self, monitor, rollupInterval=60, select=None):
+		""" Stores rollups of the paths of monitor chosen by select every
+		    rollupInterval seconds, see DbusMonitor.add_interval_stats, and
+		    flushes every flushInterval seconds on the scheduler of the
+		    monitor. Changes have to be passed to value_changed. """
+		self._monitor = monitor
+		self._rollupGroup = monitor.add_interval_stats(rollupInterval, self.add_rollups, select)
+		self._scheduler = monitor.scheduler
+		self._schedule_flush()
+
+	def _schedule_flush(self):
+		if self._scheduler is not None and self.flushInterval:
+			self._flushTimer = self._scheduler.call_later(self.flushInterval * 1000,
+				self._flush_timer)
+
+	def _flush_timer(self):
+		self.flush()
+		self._schedule_flush()
+
+	def flush(self):
+		""" Copies the segments being filled to the file, and writes the
+		    file out. """
+		self.raw.write()
+		self.rollups.write()
+		self.mm.flush()
+
+	def close(self):
+		if self._rollupGroup is not None:
+			self._monitor.remove_interval_stats(self._rollupGroup)
+			self._rollupGroup = None
+		if self._flushTimer is not None:
+			self._scheduler.cancel(self._flushTimer)
+			self._flushTimer = None
+		self.flush()
+		self.mm.close()
+
+	def _query(self, ring, serviceName, path, start, end):
+		key = serviceName + path
+		start = None if start is None else int(start * 1000)
+		end = None if end is None else int(end * 1000)
+		for data in ring.segments(start, end):
+			for k, t, tag, value in decode_segment(data):
+				if k == key and (start is None or t >= start) and (end is None or t <= end):
+					yield t / 1000.0, value
+
+	def query(self, serviceName, path, start=None, end=None):
+		""" Returns a list of (timestamp, value) of a path from start up to
+		    and including end, in seconds since the epoch, oldest first. """
+		return list(self._query(self.raw, serviceName, path, start, end))
+
+	def query_rollups(self, serviceName, path, start=None, end=None):
+		""" Returns a list of (timestamp, count, min, max, mean) of a path,
+		    as query does for values. Timestamps are those of the end of the
+		    interval. """
+		return [(t,) + value for t, value in self._query(self.rollups, serviceName, path, start, end)]
+
+	def export(self, start=None, end=None, rollups=False):
+		""" Yields (timestamp, serviceName, path, value) for all paths from
+		    start up to and including end, oldest first. Every segment is
+		    decoded once. For rollups, value is (count, min, max, mean). """
+		start = None if start is None else int(start * 1000)
+		end = None if end is None else int(end * 1000)
+		for data in (self.rollups if rollups else self.raw).segments(start, end):
+			for key, t, tag, value in decode_segment(data):
+				if (start is None or t >= start) and (end is None or t <= end):
+					serviceName, path = _split_key(key)
+					yield t / 1000.0, serviceName, path, value
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## @package ve_sharedmonitor
+# Shares the values of one DbusMonitor with other processes through shared
+# memory.
+#
+# The process that owns the monitor publishes every value into a table of
+# fixed size slots in a file, normally in /dev/shm:
+#
+#	monitor.add_listener(SharedMonitorPublisher('/dev/shm/dbusmonitor'))
+#
+# Other processes read it with a SharedMonitorReader, which has the reading
+# part of the DbusMonitor API and does no D-Bus traffic at all:
+#
+#	reader = SharedMonitorReader('/dev/shm/dbusmonitor')
+#	reader.get_value('com.victronenergy.battery.ttyO1', '/Soc')
+#
+# Each slot holds one (service, path) and is versioned with a seqlock: the
+# writer makes the sequence number odd while it changes the slot and even
+# again when it is done, and a reader retries when the number was odd or
+# changed while it read. A counter in the header changes with every write,
+# so readers can poll for changes cheaply, see SharedMonitorReader.watch.
+
+import json
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VESM'
+STALE = b'DEAD'
+VERSION = 1
+
+# magic, version, slots, slot size, generation, writer pid, changes
+HEADER = struct.Struct('<4sIIIIIQ')
+GENERATION_OFFSET = 16
+GENERATION = struct.Struct('<I')
+CHANGES_OFFSET = 24
+CHANGES = struct.Struct('<Q')
+
+# sequence number, then device instance, key length, value length, tag
+SEQ = struct.Struct('<I')
+SLOT = struct.Struct('<IiHHB3x')
+SLOT_DATA = struct.Struct('<iHHB')
+
+TAG_INVALID = 0
+TAG_INT = 1
+TAG_FLOAT = 2
+TAG_STR = 3
+TAG_JSON = 4
+TAG_TOOLARGE = 5
+
+INT64 = struct.Struct('<q')
+DOUBLE = struct.Struct('<d')
+
+READ_RETRIES = 100
+
+def _encode(value):
+	if value is None:
+		return TAG_INVALID, b''
+	if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+		return TAG_INT, INT64.pack(value)
+	if isinstance(value, float):
+		return TAG_FLOAT, DOUBLE.pack(value)
+	if isinstance(value, str):
+		return TAG_STR, value.encode('utf-8')
+	return TAG_JSON, json.dumps(value).encode('utf-8')
+
+def _decode(tag, data):
+	if tag == TAG_INT:
+		return INT64.unpack(data)[0]
+	if tag == TAG_FLOAT:
+		return DOUBLE.unpack(data)[0]
+	if tag == TAG_STR:
+		return data.decode('utf-8')
+	if tag == TAG_JSON:
+		return json.loads(data.decode('utf-8'))
+	return None
+
+class SharedMonitorPublisher(object):
+	""" Writes the values of a DbusMonitor into the shared table, pass it
+	    to DbusMonitor.add_listener. An existing table with the same layout
+	    is taken over, readers notice that through the generation number.
+	    Values that do not fit in a slot are published as invalid, paths
+	    whose service name and path do not fit are left out. """
+	def __init__(self, filename, slots=4096, slotSize=128):
+		self.filename = filename
+		self.slots = slots
+		self.slotSize = slotSize
+		self.index = {}
+		self.keys = {}
+		self.free = list(range(slots - 1, -1, -1))
+		self.seqs = [0] * slots
+		self.changes = 0
+
+		size = HEADER.size + slots * slotSize
+		generation = 0
+		try:
+			with open(filename, 'rb') as f:
+				header = f.read(HEADER.size)
+			if len(header) == HEADER.size and os.path.getsize(filename) == size:
+				magic, version, n, ss, generation, pid, changes = HEADER.unpack(header)
+				if (magic, version, n, ss) != (MAGIC, VERSION, slots, slotSize):
+					generation = None
+			else:
+				generation = None
+		except OSError:
+			generation = 0
+
+		if generation is None:
+			# Another layout, make readers of the old file look again
+			self._retire()
+			generation = 0
+
+		fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			if os.fstat(fd).st_size != size:
+				os.ftruncate(fd, size)
+			self.mm = mmap.mmap(fd, size)
+		finally:
+			os.close(fd)
+
+		# Clear the slots before making the header valid again
+		self.mm[HEADER.size:] = bytes(slots * slotSize)
+		self.generation = generation + 1
+		self.mm[:HEADER.size] = HEADER.pack(MAGIC, VERSION, slots, slotSize,
+			self.generation, os.getpid(), 0)
+
+	def _retire(self):
+		try:
+			with open(self.filename, 'r+b') as f:
+				f.write(STALE)
+			os.unlink(self.filename)
+		except OSError:
+			pass
+
+	def _bump_generation(self):
+		self.generation = (self.generation + 1) & 0xffffffff
+		GENERATION.pack_into(self.mm, GENERATION_OFFSET, self.generation)
+
+	def _write(self, slot, key, deviceInstance, value):
+		tag, data = _encode(value)
+		if SLOT.size + len(key) + len(data) > self.slotSize:
+			tag, data = TAG_TOOLARGE, b''
+
+		offset = HEADER.size + slot * self.slotSize
+		seq = self.seqs[slot] + 1
+		SEQ.pack_into(self.mm, offset, seq & 0xffffffff)
+		start = offset + SLOT.size
+		self.mm[start:start + len(key) + len(data)] = key + data
+		SLOT_DATA.pack_into(self.mm, offset + SEQ.size, deviceInstance, len(key), len(data), tag)
+		seq += 1
+		SEQ.pack_into(self.mm, offset, seq & 0xffffffff)
+		self.seqs[slot] = seq
+
+		self.changes += 1
+		CHANGES.pack_into(self.mm, CHANGES_OFFSET, self.changes)
+
+	def _clear(self, slot):
+		offset = HEADER.size + slot * self.slotSize
+		seq = self.seqs[slot] + 1
+		SEQ.pack_into(self.mm, offset, seq & 0xffffffff)
+		SLOT_DATA.pack_into(self.mm, offset + SEQ.size, 0, 0, 0, TAG_INVALID)
+		seq += 1
+		SEQ.pack_into(self.mm, offset, seq & 0xffffffff)
+		self.seqs[slot] = seq
+
+	def service_added(self, service):
+		keys = self.keys.setdefault(service.name, set())
+		for path in keys - set(service.paths):
+			self._clear(self.index.pop((service.name, path)))
+			keys.discard(path)
+
+		for path, a in service.paths.items():
+			key = (service.name + path).encode('utf-8')
+			slot = self.index.get((service.name, path))
+			if slot is None:
+				if len(key) > self.slotSize - SLOT.size:
+					logger.error("%s%s does not fit in a slot" % (service.name, path))
+					continue
+				if not self.free:
+					logger.error("No slot left for %s%s" % (service.name, path))
+					continue
+				slot = self.index[(service.name, path)] = self.free.pop()
+				keys.add(path)
+			self._write(slot, key, service.deviceInstance, a.value)
+		self._bump_generation()
+
+	def service_removed(self, service):
+		for path in self.keys.pop(service.name, ()):
+			slot = self.index.pop((service.name, path))
+			self._clear(slot)
+			self.free.append(slot)
+		self._bump_generation()
+
+	def value_changed(self, service, path, value):
+		slot = self.index.get((service.name, path))
+		if slot is not None:
+			self._write(slot, (service.name + path).encode('utf-8'), service.deviceInstance, value)
+
+	def close(self):
+		self._retire()
+		self.mm.close()
+
+class SharedMonitorReader(object):
+	""" Reads the table of a SharedMonitorPublisher, possibly in another
+	    process. Offers get_value, get_service_list, get_device_instance and
+	    seen like DbusMonitor. While there is no table, because the
+	    publisher has not started yet or has stopped, the table reads as
+	    empty, and the reader looks for it again on every call. """
+	def __init__(self, filename):
+		self.filename = filename
+		self.mm = None
+		self.generation = None
+		self.index = {}
+		self.services = {}
+		self.seqs = {}
+		self.changes = None
+		self._timer = None
+		self._open()
+
+	def _open(self):
+		""" Maps the table in the file, and only then lets go of the one
+		    mapped before. Returns False when the file holds no valid table,
+		    which is also the case while a publisher is still setting it up. """
+		try:
+			fd = os.open(self.filename, os.O_RDONLY)
+		except OSError:
+			return False
+		try:
+			mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			# An empty file can't be mapped
+			return False
+		finally:
+			os.close(fd)
+
+		valid = len(mm) >= HEADER.size
+		if valid:
+			magic, version, slots, slotSize = HEADER.unpack_from(mm)[:4]
+			valid = magic == MAGIC and version == VERSION and \
+				len(mm) >= HEADER.size + slots * slotSize
+		if not valid:
+			mm.close()
+			return False
+
+		if self.mm is not None:
+			self.mm.close()
+		self.mm = mm
+		self.slots = slots
+		self.slotSize = slotSize
+		self.generation = None
+		self.changes = None
+		self.seqs = {}
+		return True
+
+	def _clear(self):
+		self.generation = None
+		self.index = {}
+		self.services = {}
+
+	def _read_slot(self, slot):
+		""" Returns (seq, key, device instance, value) of a slot, or None if
+		    it is empty. Values that did not fit are returned as None. A slot
+		    that stays mid-write, because the publisher died while writing
+		    it, is returned as None too. """
+		mm = self.mm
+		offset = HEADER.size + slot * self.slotSize
+		for i in range(READ_RETRIES):
+			seq, di, keylen, valuelen, tag = SLOT.unpack_from(mm, offset)
+			if seq & 1:
+				continue
+			start = offset + SLOT.size
+			data = mm[start:start + keylen + valuelen]
+			if SEQ.unpack_from(mm, offset)[0] != seq:
+				continue
+			if keylen == 0:
+				return None
+			return seq, data[:keylen].decode('utf-8'), di, _decode(tag, data[keylen:])
+		return None
+
+	def _check(self):
+		""" Brings the index up to date, returns False if there is no
+		    table. """
+		if self.mm is None or self.mm[:4] != MAGIC:
+			# The publisher stopped, or started over with another layout
+			if not self._open():
+				self._clear()
+				return False
+		if GENERATION.unpack_from(self.mm, GENERATION_OFFSET)[0] != self.generation:
+			self._reindex()
+		return True
+
+	def _reindex(self):
+		while True:
+			generation = GENERATION.unpack_from(self.mm, GENERATION_OFFSET)[0]
+			index = {}
+			services = {}
+			for slot in range(self.slots):
+				item = self._read_slot(slot)
+				if item is not None:
+					index[item[1]] = slot
+					services[item[1][:item[1].index('/')]] = item[2]
+			if GENERATION.unpack_from(self.mm, GENERATION_OFFSET)[0] == generation:
+				break
+		self.generation = generation
+		self.index = index
+		self.services = services
+
+	def get_value(self, serviceName, objectPath, default_value=None):
+		self._check()
+		slot = self.index.get(serviceName + objectPath)
+		if slot is None:
+			return default_value
+		item = self._read_slot(slot)
+		if item is None or item[1] != serviceName + objectPath or item[3] is None:
+			return default_value
+		return item[3]
+
+	def seen(self, serviceName, objectPath):
+		self._check()
+		return serviceName + objectPath in self.index
+
+	def get_service_list(self, classfilter=None):
+		self._check()
+		if classfilter is None:
+			return dict(self.services)
+		return {name: di for name, di in self.services.items() \
+			if name.startswith(classfilter + '.')}
+
+	def get_device_instance(self, serviceName):
+		self._check()
+		return self.services[serviceName]
+
+	def poll(self):
+		""" Returns (serviceName, path, value, deviceInstance) for the slots
+		    that were written since the previous poll. The first poll returns
+		    everything. Values that changed more than once in between are
+		    only returned once, with the latest value. """
+		if not self._check():
+			return []
+		changes = CHANGES.unpack_from(self.mm, CHANGES_OFFSET)[0]
+		if changes == self.changes:
+			return []
+		self.changes = changes
+
+		result = []
+		seqs = {}
+		for key, slot in self.index.items():
+			item = self._read_slot(slot)
+			if item is None or item[1] != key:
+				continue
+			seqs[key] = item[0]
+			if self.seqs.get(key) != item[0]:
+				i = key.index('/')
+				result.append((key[:i], key[i:], item[3], item[2]))
+		self.seqs = seqs
+		return result
+
+	def watch(self, scheduler, callback, interval=100):
+		""" Polls every interval milliseconds on scheduler, for example a
+		    dbusmonitor.GLibScheduler, and calls callback like the
+		    valueChangedCallback of a DbusMonitor for every change. Options
+		    are None, and the Text is made from the value. """
+		self._scheduler = scheduler
+		self._timer = scheduler.call_later(interval, self._watch, callback, interval)
+
+	def _watch(self, callback, interval):
+		self._timer = self._scheduler.call_later(interval, self._watch, callback, interval)
+		for serviceName, path, value, di in self.poll():
+			callback(serviceName, path, None, {'Value': value, 'Text': str(value)}, di)
+
+	def close(self):
+		if self._timer is not None:
+			self._scheduler.cancel(self._timer)
+			self._timer = None
+		if self.mm is not None:
+			self.mm.close()
+			self.mm = None
@@ -13,6 +13,65 @@ VEDBUS_INVALID = dbus.Array([], signature=dbus.Signature('i'), variant_level=1)
 class NoVrmPortalIdError(Exception):
 	pass
 
+class ValueChanges(dict):
+	""" Changes dictionary for a signal that did not carry a Text. The Text
+	    is only made from the Value when someone asks for it, including by
+	    iterating over or copying the dictionary, so that it looks the same
+	    as one that had the Text all along. """
+	def __missing__(self, key):
+		if key != 'Text':
+			raise KeyError(key)
+		text = self['Text'] = str(unwrap_dbus_value(self['Value']))
+		return text
+
+	def _fill(self):
+		if not dict.__contains__(self, 'Text'):
+			self['Text']
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __contains__(self, key):
+		return key == 'Text' or dict.__contains__(self, key)
+
+	def __len__(self):
+		return dict.__len__(self) + (not dict.__contains__(self, 'Text'))
+
+	def __iter__(self):
+		self._fill()
+		return dict.__iter__(self)
+
+	def keys(self):
+		self._fill()
+		return dict.keys(self)
+
+	def values(self):
+		self._fill()
+		return dict.values(self)
+
+	def items(self):
+		self._fill()
+		return dict.items(self)
+
+	def copy(self):
+		self._fill()
+		return dict(dict.items(self))
+
+	def __eq__(self, other):
+		self._fill()
+		return dict.__eq__(self, other)
+
+	def __ne__(self, other):
+		self._fill()
+		return dict.__ne__(self, other)
+
+	def __repr__(self):
+		self._fill()
+		return dict.__repr__(self)
+
 # Use this function to make sure the code quits on an unexpected exception. Make sure to use it
 # when using GLib.idle_add and also GLib.timeout_add.
 # Without this, the code will just keep running, since GLib does not stop the mainloop on an
@@ -6,7 +6,7 @@ import logging
 import os
 import weakref
 from collections import defaultdict
-from ve_utils import wrap_dbus_value, unwrap_dbus_value
+from ve_utils import wrap_dbus_value, unwrap_dbus_value, ValueChanges
 
 notset = object()
 
@@ -59,13 +59,16 @@ notset = object()
 
 # Export ourselves as a D-Bus service.
 class VeDbusService(object):
-	def __init__(self, servicename, bus=None, register=None):
+	# @param sendtext	Default for add_path, set to False to leave the Text out of change signals
+	#					for paths of which the text is just the value as a string.
+	def __init__(self, servicename, bus=None, register=None, sendtext=True):
 		# dict containing the VeDbusItemExport objects, with their path as the key.
 		self._dbusobjects = {}
 		self._dbusnodes = {}
 		self._ratelimiters = []
 		self._dbusname = None
 		self.name = servicename
+		self.sendtext = sendtext
 
 		# dict containing the onchange callbacks, for each object. Object path is the key
 		self._onchangecallbacks = {}
@@ -113,15 +116,31 @@ class VeDbusService(object):
 	# @param callbackonchange	function that will be called when this value is changed. First parameter will
 	#							be the path of the object, second the new value. This callback should return
 	#							True to accept the change, False to reject it.
+	# @param sendtext			Whether to include the Text in change signals, see VeDbusItemExport. None
+	#							means use the default passed to the constructor.
+	# @param textformat			Format string for the text, eg '%.1fV' or '{:.1f}V'. Cheaper than a
+	#							gettextcallback that does the same.
 	def add_path(self, path, value, description="", writeable=False,
-					onchangecallback=None, gettextcallback=None, valuetype=None, itemtype=None):
+					onchangecallback=None, gettextcallback=None, valuetype=None, itemtype=None,
+					sendtext=None, textformat=None):
 
 		if onchangecallback is not None:
 			self._onchangecallbacks[path] = onchangecallback
 
+		# Only pass the new arguments when used, so that item types that
+		# predate them keep working.
+		kwargs = {}
+		if sendtext is None:
+			sendtext = self.sendtext
+		if not sendtext:
+			kwargs['sendtext'] = False
+		if textformat is not None:
+			kwargs['textformat'] = textformat
+
 		itemtype = itemtype or VeDbusItemExport
 		item = itemtype(self._dbusconn, path, value, description, writeable,
-				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype)
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype,
+				**kwargs)
 
 		spl = path.split('/')
 		for i in range(2, len(spl)):
@@ -218,10 +237,7 @@ class ServiceContext(object):
 
 	def add_path(self, path, value, *args, **kwargs):
 		self.parent.add_path(path, value, *args, **kwargs)
-		self.changes[path] = {
-			'Value': wrap_dbus_value(value),
-			'Text': self.parent._dbusobjects[path].GetText()
-		}
+		self.changes[path] = self.parent._dbusobjects[path].get_changes()
 
 	def del_tree(self, root):
 		root = root.rstrip('/')
@@ -262,18 +278,24 @@ class VeDbusRootTracker(object):
 			return
 
 		for path, changes in items.items():
-			try:
-				v = changes['Value']
-			except KeyError:
+			importers = self.importers.get(path, None)
+			if not importers:
 				continue
 
 			try:
-				t = changes['Text']
+				v = changes['Value']
 			except KeyError:
-				t = str(unwrap_dbus_value(v))
+				continue
 
-			for i in self.importers.get(path, ()):
-				i._properties_changed_handler({'Value': v, 'Text': t})
+			# Only make a Text if the receiver asks for it. Every importer
+			# gets its own dictionary, so that one can't change what the
+			# next one sees.
+			t = changes.get('Text', notset)
+			for i in importers:
+				if t is notset:
+					i._properties_changed_handler(ValueChanges(Value=v))
+				else:
+					i._properties_changed_handler({'Value': v, 'Text': t})
 
 """
 Importing basics:
@@ -503,9 +525,15 @@ class VeDbusItemExport(dbus.service.Object):
 	# @param callback	  Function that will be called when someone else changes the value of this VeBusItem
 	#                     over the dbus. First parameter passed to callback will be our path, second the new
 	#					  value. This callback should return True to accept the change, False to reject it.
+	# @param sendtext	  When False, PropertiesChanged and ItemsChanged signals carry only the Value, as long
+	#					  as the text is just the value as a string. Receivers then make the text themselves.
+	#					  GetText and GetItems are not affected.
+	# @param textformat	  Format string used to make the text, either %-style ('%.1fV') or str.format
+	#					  style ('{:.1f}V'). Used instead of calling a gettextcallback for simple cases,
+	#					  the text is only formatted again when the value changes.
 	def __init__(self, bus, objectPath, value=None, description=None, writeable=False,
 					onchangecallback=None, gettextcallback=None, deletecallback=None,
-					valuetype=None):
+					valuetype=None, sendtext=True, textformat=None):
 		dbus.service.Object.__init__(self, bus, objectPath)
 		self._path = objectPath
 		self._onchangecallback = onchangecallback
@@ -515,6 +543,9 @@ class VeDbusItemExport(dbus.service.Object):
 		self._writeable = writeable
 		self._deletecallback = deletecallback
 		self._type = valuetype
+		self._sendtext = sendtext
+		self._formattext = _compile_text_format(textformat)
+		self._text = (notset, None)
 
 	# To force immediate deregistering of this dbus object, explicitly call __del__().
 	def __del__(self):
@@ -539,10 +570,23 @@ class VeDbusItemExport(dbus.service.Object):
 			return None
 
 		self._value = newvalue
-		return {
-			'Value': wrap_dbus_value(newvalue),
-			'Text': self.GetText()
-		}
+		return self.get_changes()
+
+	## Returns the changes to send in a PropertiesChanged or ItemsChanged signal
+	def get_changes(self):
+		if self._sendtext or not self._text_is_value():
+			return {
+				'Value': wrap_dbus_value(self._value),
+				'Text': self.GetText()
+			}
+		return {'Value': wrap_dbus_value(self._value)}
+
+	# True when GetText would return nothing more than str() of the value, so that
+	# receivers can make the text themselves.
+	def _text_is_value(self):
+		return self._value is not None and self._gettextcallback is None and \
+			self._formattext is None and type(self._value) != dbus.Byte and \
+			self.__dbus_object_path__ != '/ProductId'
 
 	def local_get_value(self):
 		return self._value
@@ -618,6 +662,9 @@ class VeDbusItemExport(dbus.service.Object):
 		if self._value is None:
 			return '---'
 
+		if self._formattext is not None:
+			return self._get_formatted_text()
+
 		# Default conversion from dbus.Byte will get you a character (so 'T' instead of '84'), so we
 		# have to convert to int first. Note that if a dbus.Byte turns up here, it must have come from
 		# the application itself, as all data from the D-Bus should have been unwrapped by now.
@@ -632,6 +679,20 @@ class VeDbusItemExport(dbus.service.Object):
 
 		return self._gettextcallback(self.__dbus_object_path__, self._value)
 
+	def _get_formatted_text(self):
+		# Cache the text for the current value. Compare the type as well, as
+		# 1, 1.0 and True are equal but may format differently.
+		value, text = self._text
+		if type(value) is type(self._value) and value == self._value:
+			return text
+
+		try:
+			text = self._formattext(self._value)
+		except (TypeError, ValueError):
+			text = str(self._value)
+		self._text = (self._value, text)
+		return text
+
 	## The signal that indicates that the value has changed.
 	# Other processes connected to this BusItem object will have subscribed to the
 	# event when they want to track our state.
@@ -639,6 +700,14 @@ class VeDbusItemExport(dbus.service.Object):
 	def PropertiesChanged(self, changes):
 		pass
 
+# Returns a function that formats a value using a %-style or str.format style format string
+def _compile_text_format(textformat):
+	if textformat is None:
+		return None
+	if '{' in textformat:
+		return textformat.format
+	return textformat.__mod__
+
 ## This class behaves like a regular reference to a class method (eg. self.foo), but keeps a weak reference
 ## to the object which method is to be called.
 ## Use this object to break circular references.